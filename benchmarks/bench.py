@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+#
+# Signal Protocol Python library
+# benchmarks/bench.py - benchmark suite
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Benchmark suite for the pysignal library.
+
+signal-cli is replaced by the fake signal-cli script in this directory, so
+these benchmarks measure the overhead of pysignal itself (including process
+spawning), not the Signal service.
+
+Usage:
+  benchmarks/bench.py [--quick] [--benchmark NAME ...] [--output FILE]
+
+Results are written as JSON, to FILE or standard output. A human-readable
+summary is printed to standard error.
+'''
+
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKE_SIGNAL_CLI = os.path.join(HERE, "signal-cli")
+
+sys.path.insert(0, os.path.join(HERE, "..", "src"))
+
+# pylint: disable=wrong-import-position
+import pysignal
+import pysignal.attachment
+import pysignal.crypt
+import pysignal.message
+
+
+USERNAME = "+64210000000"
+
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(name):
+    '''
+    Register a benchmark function. It is called with a boolean saying whether
+    to run the quick variant, and returns a list of result dicts.
+    '''
+
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+
+    return decorator
+
+
+#
+## Helpers.
+#
+
+
+def percentile(values, fraction):
+    '''
+    '''
+
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def measure(name, func, count, concurrency=1, items=1, **params):
+    '''
+    Call func() count times, from concurrency threads, and return a result dict.
+
+    items is the number of items (e.g. messages) each call handles, for
+    reporting items per second.
+    '''
+
+    latencies = []
+    errors = 0
+
+    def timed():
+        start = time.perf_counter()
+        try:
+            func()
+            return (time.perf_counter() - start, None)
+        except Exception as err: # pylint: disable=broad-except
+            return (time.perf_counter() - start, err)
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        results = [timed() for _ in range(count)]
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda _: timed(), range(count)))
+    elapsed = time.perf_counter() - start
+
+    for latency, error in results:
+        latencies.append(latency)
+        if error is not None:
+            errors += 1
+
+    params["concurrency"] = concurrency
+    return {
+        "benchmark": name,
+        "params": params,
+        "ops": count,
+        "errors": errors,
+        "seconds": elapsed,
+        "ops_per_sec": count / elapsed if elapsed else None,
+        "items_per_sec": count * items / elapsed if elapsed else None,
+        "p50_ms": percentile(latencies, 0.50) * 1000.0,
+        "p99_ms": percentile(latencies, 0.99) * 1000.0,
+    }
+
+
+def fake_env(**values):
+    '''
+    Set the fake signal-cli configuration environment variables.
+    '''
+
+    for key in list(os.environ):
+        if key.startswith("FAKE_SIGNAL_CLI_"):
+            del os.environ[key]
+    os.environ["FAKE_SIGNAL_CLI_SEED"] = "1"
+    for key, value in values.items():
+        os.environ["FAKE_SIGNAL_CLI_{}".format(key.upper())] = str(value)
+
+
+def fake_output(command, output="text", **values):
+    '''
+    Return the output of the fake signal-cli for the given command.
+    '''
+
+    fake_env(**values)
+    args = [FAKE_SIGNAL_CLI, "-u", USERNAME]
+    if output == "json":
+        args.append("--output=json")
+    args.append(command)
+    return subprocess.check_output(args, universal_newlines=True)
+
+
+#
+## Benchmarks.
+#
+
+
+@benchmark("send")
+def bench_send(quick):
+    '''
+    One-shot and daemon sends to a single recipient, at several concurrency levels.
+    '''
+
+    results = []
+    count = 20 if quick else 200
+
+    for daemon in (False, True):
+        for concurrency in (1, 4, 16):
+            fake_env(failures=0)
+            signal = pysignal.Signal(USERNAME, signal_cli=FAKE_SIGNAL_CLI, daemon=daemon)
+            try:
+                results.append(measure(
+                    "send",
+                    lambda: signal.send("Benchmark", recipient="+64211234567"),
+                    count,
+                    concurrency=concurrency,
+                    daemon=daemon,
+                ))
+            finally:
+                signal.close()
+
+    return results
+
+
+@benchmark("send_failures")
+def bench_send_failures(quick):
+    '''
+    Bulk sends with injected per-recipient failures and retries.
+    '''
+
+    results = []
+    recipients = ["+6421{:07d}".format(i) for i in range(100 if quick else 1000)]
+
+    for concurrency in (1, 4):
+        fake_env(failures=0.05, latency=0.01)
+        signal = pysignal.Signal(USERNAME, signal_cli=FAKE_SIGNAL_CLI)
+        results.append(measure(
+            "send_many",
+            lambda: signal.send_many([("Benchmark", recipients)], batch_size=50,
+                                     concurrency=concurrency),
+            3,
+            items=len(recipients),
+            recipients=len(recipients),
+            failure_rate=0.05,
+            workers=concurrency,
+        ))
+
+    return results
+
+
+@benchmark("receive")
+def bench_receive(quick):
+    '''
+    One-shot receive, including process spawn and parsing, at several backlog sizes.
+    '''
+
+    results = []
+    count = 5 if quick else 20
+
+    for output in ("text", "json"):
+        for backlog in (0, 100, 1000, 10000):
+            fake_env(messages=backlog)
+            signal = pysignal.Signal(USERNAME, signal_cli=FAKE_SIGNAL_CLI, output=output)
+            results.append(measure(
+                "receive",
+                signal.receive,
+                count,
+                items=backlog,
+                backlog=backlog,
+                output=output,
+            ))
+            results.append(measure(
+                "receive_iter",
+                lambda: collections.deque(signal.receive_iter(), maxlen=0),
+                count,
+                items=backlog,
+                backlog=backlog,
+                output=output,
+            ))
+
+    return results
+
+
+@benchmark("messages_read")
+def bench_messages_read(quick):
+    '''
+    Parsing receive output, without running signal-cli.
+    '''
+
+    results = []
+    count = 5 if quick else 50
+
+    for output in ("text", "json"):
+        fmt = pysignal.parse.output_format(output)
+        for backlog in (100, 1000, 10000, 100000):
+            data = fake_output("receive", output=output, messages=backlog)
+            results.append(measure(
+                "messages_read",
+                lambda: fmt.messages_read(data),
+                count,
+                items=backlog,
+                backlog=backlog,
+                bytes=len(data),
+                output=output,
+            ))
+
+    return results
+
+
+@benchmark("identities_read")
+def bench_identities_read(quick):
+    '''
+    Parsing listIdentities output, without running signal-cli.
+    '''
+
+    results = []
+    count = 5 if quick else 50
+
+    for output in ("text", "json"):
+        fmt = pysignal.parse.output_format(output)
+        for identities in (10, 100, 1000, 10000):
+            data = fake_output("listIdentities", output=output, identities=identities)
+            results.append(measure(
+                "identities_read",
+                lambda: fmt.identities_read(data),
+                count,
+                items=identities,
+                identities=identities,
+                output=output,
+            ))
+
+    return results
+
+
+def naive_encode(message):
+    '''
+    Baseline PushMessageContent encoder, concatenating bytes as it goes.
+    '''
+
+    def varint(value):
+        data = b""
+        while value >= 0x80:
+            data += bytes([(value & 0x7F) | 0x80])
+            value >>= 7
+        return data + bytes([value])
+
+    def field(tag, data):
+        return bytes([tag]) + varint(len(data)) + data
+
+    def attachment(pointer):
+        data = b""
+        if pointer.id is not None:
+            data += b"\x09" + pointer.id.to_bytes(8, "little")
+        if pointer.content_type is not None:
+            data += field(0x12, pointer.content_type.encode("utf-8"))
+        if pointer.key is not None:
+            data += field(0x1a, pointer.key)
+        return data
+
+    data = b""
+    if message.body is not None:
+        data += field(0x0a, message.body.encode("utf-8"))
+    for pointer in message.attachments:
+        data += field(0x12, attachment(pointer))
+    if message.flags is not None:
+        data += b"\x20" + varint(message.flags)
+    return data
+
+
+def naive_decode(data):
+    '''
+    Baseline PushMessageContent decoder, slicing out a copy of every field.
+    '''
+
+    def varint(data):
+        value = shift = i = 0
+        while True:
+            byte = data[i]
+            i += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value, data[i:]
+            shift += 7
+
+    def fields(data):
+        while data:
+            tag, data = varint(data)
+            if tag & 0x07 == 2:
+                length, data = varint(data)
+                yield tag, data[:length]
+                data = data[length:]
+            elif tag & 0x07 == 1:
+                yield tag, data[:8]
+                data = data[8:]
+            else:
+                value, data = varint(data)
+                yield tag, value
+
+    body, attachments, flags = None, [], None
+    for tag, value in fields(data):
+        if tag == 0x0a:
+            body = value.decode("utf-8")
+        elif tag == 0x12:
+            pointer = {}
+            for subtag, subvalue in fields(value):
+                if subtag == 0x09:
+                    pointer["id"] = int.from_bytes(subvalue, "little")
+                elif subtag == 0x12:
+                    pointer["content_type"] = subvalue.decode("utf-8")
+                elif subtag == 0x1a:
+                    pointer["key"] = subvalue
+            attachments.append(pysignal.attachment.AttachmentPointer(
+                pointer.get("id"),
+                pointer.get("content_type"),
+                pointer.get("key"),
+            ))
+        elif tag == 0x20:
+            flags = value
+    return pysignal.message.PushMessageContent(body, attachments, None, flags)
+
+
+@benchmark("message_codec")
+def bench_message_codec(quick):
+    '''
+    PushMessageContent encode/decode round trips, against a naive baseline.
+    '''
+
+    results = []
+    count = 5 if quick else 50
+    batch = 1000
+
+    for attachments in (0, 2):
+        for body_size in (32, 1024):
+            messages = [
+                pysignal.message.PushMessageContent(
+                    "x" * body_size,
+                    [
+                        pysignal.attachment.AttachmentPointer(i, "image/png", os.urandom(64))
+                        for i in range(attachments)
+                    ],
+                )
+                for _ in range(batch)
+            ]
+            params = {"attachments": attachments, "body_size": body_size, "batch": batch}
+
+            results.append(measure(
+                "message_naive",
+                lambda: [naive_decode(naive_encode(message)) for message in messages],
+                count,
+                items=batch,
+                **params
+            ))
+            results.append(measure(
+                "message_codec",
+                lambda: [
+                    pysignal.message.PushMessageContent.from_bytes(message.to_bytes())
+                    for message in messages
+                ],
+                count,
+                items=batch,
+                **params
+            ))
+
+            buffer = bytearray(len(pysignal.message.encode_many(messages)))
+
+            def batch_round_trip():
+                end = pysignal.message.encode_many_into(messages, buffer)
+                pysignal.message.decode_many(buffer, 0, end)
+
+            results.append(measure("message_batch", batch_round_trip, count, items=batch, **params))
+
+    return results
+
+
+@benchmark("crypt")
+def bench_crypt(quick):
+    '''
+    Encrypting many small messages with cached sessions, against setting up
+    a new cipher for every message.
+    '''
+
+    if pysignal.crypt.AESGCM is None:
+        sys.stderr.write("crypt: skipped, the cryptography package is not installed\n")
+        return []
+
+    results = []
+    count = 3 if quick else 20
+    batch = 1000 if quick else 10000
+    recipients = ["+6421{:07d}".format(i) for i in range(100)]
+    keys = {recipient: os.urandom(pysignal.crypt.KEY_SIZE) for recipient in recipients}
+
+    for size in (64, 1024):
+        items = [(recipients[i % len(recipients)], os.urandom(size)) for i in range(batch)]
+        params = {"message_size": size, "batch": batch}
+
+        def naive():
+            for recipient, plaintext in items:
+                nonce = os.urandom(pysignal.crypt.NONCE_SIZE)
+                pysignal.crypt.AESGCM(keys[recipient]).encrypt(nonce, plaintext, None)
+
+        results.append(measure("crypt_naive", naive, count, items=batch, **params))
+
+        for workers in (None, 4):
+            cache = pysignal.crypt.SessionCache(workers=workers)
+            for recipient, key in keys.items():
+                cache.add(recipient, key=key)
+            out = bytearray(sum(len(plaintext) + pysignal.crypt.OVERHEAD for _, plaintext in items))
+            encrypted, offsets = cache.encrypt_many(items)
+            ciphertexts = [
+                (recipient, encrypted[start:end])
+                for (recipient, _), (start, end) in zip(items, offsets)
+            ]
+
+            if workers is None:
+                results.append(measure(
+                    "crypt_encrypt",
+                    lambda: [cache.encrypt(recipient, plaintext) for recipient, plaintext in items],
+                    count,
+                    items=batch,
+                    **params
+                ))
+            results.append(measure(
+                "crypt_encrypt_many",
+                lambda: cache.encrypt_many(items, out),
+                count,
+                items=batch,
+                workers=workers or 1,
+                **params
+            ))
+            results.append(measure(
+                "crypt_decrypt_many",
+                lambda: cache.decrypt_many(ciphertexts),
+                count,
+                items=batch,
+                workers=workers or 1,
+                **params
+            ))
+            cache.close()
+
+    return results
+
+
+#
+## Main.
+#
+
+
+def summary(result):
+    '''
+    '''
+
+    params = " ".join("{}={}".format(key, value) for key, value in sorted(result["params"].items()))
+    return "{:<16} {:<60} {:>10.1f} ops/s {:>12.1f} items/s p50 {:>9.3f} ms p99 {:>9.3f} ms{}".format(
+        result["benchmark"],
+        params,
+        result["ops_per_sec"],
+        result["items_per_sec"],
+        result["p50_ms"],
+        result["p99_ms"],
+        " ({} errors)".format(result["errors"]) if result["errors"] else "",
+    )
+
+
+def main():
+    '''
+    '''
+
+    parser = argparse.ArgumentParser(description="pysignal benchmark suite")
+    parser.add_argument("--quick", action="store_true", help="run fewer iterations")
+    parser.add_argument(
+        "--benchmark",
+        action="append",
+        choices=list(BENCHMARKS),
+        help="benchmark to run (default: all)",
+    )
+    parser.add_argument("--output", help="file to write JSON results to (default: stdout)")
+    args = parser.parse_args()
+
+    report = {
+        "date": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "results": [],
+    }
+
+    for name in args.benchmark or BENCHMARKS:
+        for result in BENCHMARKS[name](args.quick):
+            sys.stderr.write(summary(result) + "\n")
+            report["results"].append(result)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+            output.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -69,6 +69,10 @@ setuptools.setup(
 
     install_requires = [],
 
+    extras_require = {
+        "crypt": ["cryptography"],
+    },
+
     packages = setuptools.find_packages(where=os.path.join(here, "src")),
     package_dir = {"": "src"},
 )
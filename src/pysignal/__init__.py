@@ -23,55 +23,167 @@ Signal Protocol Python library.
 '''
 
 
-import datetime
+import collections
+import concurrent.futures
 import io
+import json
+import os
 import re
 import shutil
 import subprocess
+import tempfile
 import threading
+import time
 
+from pysignal import parse
+from pysignal.attachment import AttachmentCache
+from pysignal.daemon import SignalDaemon
+from pysignal.exception import DaemonError
 from pysignal.exception import SignalCLIError
+from pysignal.exception import SignalCLITimeoutError
+from pysignal.exception import ParseError
 from pysignal.exception import ReceiptNotFoundError
+from pysignal.exception import UntrustedIdentityError
+from pysignal.identity import IdentityCache
+from pysignal.message import PushMessageContent
+from pysignal.metrics import MetricsCollector
+from pysignal.metrics import Observer
+from pysignal.parse import Envelope
+from pysignal.parse import Identity
+from pysignal.ratelimit import SendScheduler
+from pysignal.receipt import ReceiptHandle
+from pysignal.receipt import ReceiptTracker
+from pysignal.spool import OutboundSpool
+from pysignal.store import MessageStore
+from pysignal.subscription import Subscription
 
 
 SIGNAL_CLI = shutil.which("signal-cli")
 
+# Per-recipient send failures that will not go away by retrying.
+SEND_ERRORS_PERMANENT = (
+    "Untrusted Identity",
+    "Unregistered user",
+    "Invalid number",
+    "IDENTITY_FAILURE",
+    "UNREGISTERED_FAILURE",
+)
+
+SEND_ERROR_RE = re.compile(r'^(.+?)(?: for)? "(\+[0-9]+)"(?:: ?(.*))?$')
+
+
+SendJob = collections.namedtuple("SendJob", ("message", "recipients", "attachments"))
+SendJob.__new__.__defaults__ = (None,)
+
+SendResult = collections.namedtuple(
+    "SendResult",
+    ("message", "recipient", "success", "error", "attempts"),
+)
+
 
 class Signal(object):
     '''
     '''
 
 
-    def __init__(self, username, signal_cli=SIGNAL_CLI):
+    # pylint: disable=too-many-arguments
+    def __init__(self, username, signal_cli=SIGNAL_CLI, daemon=False, output="text",
+                 observer=None, spool=None, store=None):
         '''
+        If daemon is True, keep a single signal-cli process running in JSON-RPC mode
+        for this account, instead of spawning signal-cli for every call.
+
+        output selects how one-shot signal-cli output is read: "text" parses the
+        human-readable output, "json" asks signal-cli for JSON output instead.
+
+        observer is an optional pysignal.metrics.Observer (e.g. a
+        MetricsCollector), told about process, parsing and lock-wait timings.
+
+        spool is an optional directory for a durable outbound spool, used by
+        send_durable(). Each account has its own spool file in it, so the same
+        directory can be used for many accounts. Messages left unsent in it by
+        a previous run are sent again straight away.
+
+        store is an optional SQLite file in which to keep every envelope
+        received, for querying later through self.store.
         '''
 
         self.username = username # Says username, is actually user's registered phone number.
         self.signal_cli = signal_cli
+        self.output = parse.output_format(output)
+        self.observer = observer
 
         self.lock = threading.Lock()
 
+        self.daemon = SignalDaemon(signal_cli, username, observer=observer) if daemon else None
+        self.receipts = ReceiptTracker(self)
+        self.identities = IdentityCache(self)
+        self.attachments = AttachmentCache()
+
+        self.store = MessageStore(store) if store is not None else None
+
+        self.spool = None
+        if spool is not None:
+            self.spool = OutboundSpool(self, spool)
+            self.spool.start()
+
+
+    def close(self):
+        '''
+        Stop background receipt tracking and the signal-cli daemon, if running.
+        '''
+
+        if self.spool is not None:
+            self.spool.close()
+        self.receipts.stop()
+        if self.daemon is not None:
+            self.daemon.close()
+        if self.store is not None:
+            self.store.close()
+
 
     #
     ##
     #
 
 
-    def signal_cli_call(self, *args, username=self.username, timeout=60):
+    def signal_cli_args(self, args, username=None):
         '''
+        Build the full signal-cli command line for the given subcommand arguments.
         '''
 
-        process_args = [self.signal_cli]
+        process_args = [self.signal_cli, "-u", username or self.username]
+        process_args.extend(self.output.args)
         process_args.extend(args)
-        process_args.extend(["-u", username])
+        return process_args
+
+
+    def signal_cli_call(self, *args, username=None, timeout=60):
+        '''
+        Run a one-shot signal-cli command, and return its (stdout, stderr).
+        '''
+
+        observer = self.observer
+        if observer is not None:
+            labels = {"operation": args[0]}
+            start = time.perf_counter()
 
         try:
             process = subprocess.Popen(
-                process_args,
+                self.signal_cli_args(args, username),
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
+                universal_newlines=True,
             )
-            stdout, stderr = process.communicate(30)
+            if observer is not None:
+                spawned = time.perf_counter()
+                observer.timing("spawn_seconds", spawned - start, labels)
+
+            stdout, stderr = process.communicate(timeout=timeout)
+
+            if observer is not None:
+                observer.timing("wait_seconds", time.perf_counter() - spawned, labels)
+                self.observe_exit(labels, process.returncode, stdout, stderr)
 
             if process.returncode != 0:
                 raise SignalCLIError(process.returncode, stderr)
@@ -81,18 +193,30 @@ class Signal(object):
         except subprocess.TimeoutExpired:
             process.kill()
             stdout, stderr = process.communicate()
-            raise RuntimeError(
-                "timeout reached ({} seconds)\n\nstdout:\n{}\n\nstderr:\n{}".format(
-                    timeout,
-                    stdout,
-                    stderr,
-                ),
-            )
+            if observer is not None:
+                self.observe_exit(labels, "timeout", stdout, stderr)
+            raise SignalCLITimeoutError(timeout, stdout, stderr)
 
         except subprocess.CalledProcessError:
             raise # TODO: handle appropriately
 
 
+    def observe_exit(self, labels, returncode, stdout, stderr):
+        '''
+        Report the outcome of a signal-cli call to the observer. Output sizes
+        are counted in decoded characters.
+        '''
+
+        observer = self.observer
+        observer.count("calls", 1, labels)
+        if stdout:
+            observer.count("stdout_bytes", len(stdout), labels)
+        if stderr:
+            observer.count("stderr_bytes", len(stderr), labels)
+        if returncode != 0:
+            observer.count("errors", 1, dict(labels, returncode=returncode))
+
+
 
     #
     ## Receiving methods.
@@ -104,103 +228,185 @@ class Signal(object):
         Receive all unread messages from Signal and return them.
 
         This method is blocking, and cannot be used concurrently with other threads
-        attempting to run receive() or send().
+        attempting to run receive().
         '''
 
-        self.lock.acquire(blocking=True)
+        self.receipts.poll()
+        return self.receipts.drain()
 
-        try:
-            return self.receive_messages_get()
-        finally:
-            self.lock.release()
 
+    def receive_messages_get(self, timeout=None):
+        '''
+        Receive messages from signal-cli once, storing them if there is a store.
 
-    def receive_messages_get(self):
+        If timeout is given, wait up to that many seconds for messages to arrive
+        (signal-cli's receive timeout), rather than returning straight away.
         '''
+
+        if self.daemon is not None:
+            messages = [
+                message
+                for envelope in self.daemon.receive(timeout)
+                for message in Signal.messages_from_json(envelope)
+            ]
+
+        else:
+            if timeout is None:
+                stdout, _ = self.signal_cli_call("receive")
+            else:
+                stdout, _ = self.signal_cli_call(
+                    "receive", "-t", str(timeout),
+                    timeout=timeout + 60,
+                )
+            if self.observer is None:
+                messages = self.output.messages_read(stdout)
+            else:
+                start = time.perf_counter()
+                messages = self.output.messages_read(stdout)
+                self.observer.timing(
+                    "parse_seconds",
+                    time.perf_counter() - start,
+                    {"operation": "receive"},
+                )
+
+        if self.store is not None:
+            self.store.add_many(messages)
+
+        return messages
+
+
+    def receive_iter(self):
+        '''
+        Receive all unread messages from Signal, yielding each one as soon as
+        signal-cli has finished printing it.
+
+        Only one message is held in memory at a time, so this is suitable for
+        draining large backlogs. Receipts for messages sent with verify_receipt
+        resolve their handles, and are not yielded. The lock is held until the generator is exhausted
+        or closed, so the same restrictions as receive() apply.
+        '''
+
+        # Messages collected while waiting for receipts come first.
+        yield from self.receipts.drain()
+
+        observer = self.observer
+        if observer is not None:
+            labels = {"operation": "receive"}
+            start = time.perf_counter()
+
+        with self.lock:
+            if observer is not None:
+                locked = time.perf_counter()
+                observer.timing("lock_wait_seconds", locked - start, labels)
+
+            if self.daemon is not None:
+                messages = (
+                    message
+                    for envelope in self.daemon.receive()
+                    for message in Signal.messages_from_json(envelope)
+                )
+                if self.store is not None:
+                    messages = self.store.recording(messages)
+                yield from self.receipts_filter(messages)
+                return
+
+            # stderr goes to a file rather than a pipe, so a chatty signal-cli
+            # can't block on a full stderr pipe while we are reading stdout.
+            with tempfile.TemporaryFile(mode="w+") as stderr:
+                process = subprocess.Popen(
+                    self.signal_cli_args(["receive"]),
+                    stdout=subprocess.PIPE,
+                    stderr=stderr,
+                    universal_newlines=True,
+                )
+                if observer is not None:
+                    spawned = time.perf_counter()
+                    observer.timing("spawn_seconds", spawned - locked, labels)
+
+                try:
+                    messages = self.output.messages_iter(process.stdout)
+                    if self.store is not None:
+                        messages = self.store.recording(messages)
+                    yield from self.receipts_filter(messages)
+                finally:
+                    if process.poll() is None:
+                        # The caller stopped iterating early.
+                        process.kill()
+                    process.stdout.close()
+                    process.wait()
+
+                if observer is not None:
+                    # Parsing is interleaved with reading, so is included here.
+                    observer.timing("wait_seconds", time.perf_counter() - spawned, labels)
+                    stderr.seek(0)
+                    self.observe_exit(labels, process.returncode, None, stderr.read())
+
+                if process.returncode != 0:
+                    stderr.seek(0)
+                    raise SignalCLIError(process.returncode, stderr.read())
+
+
+    def receipts_filter(self, messages):
+        '''
+        Pass each message through the receipt tracker, yielding those which
+        aren't receipts for tracked messages.
+        '''
+
+        consume = self.receipts.consume
+        for message in messages:
+            if not consume(message):
+                yield message
+
+
+    def subscribe(self, handler, workers=4, **kwargs):
+        '''
+        Receive messages continuously in the background, calling handler(envelope)
+        for each one on a pool of worker threads, and return the running
+        Subscription. Call its stop() method to stop receiving.
+
+        Messages from the same sender are handled in order. Other keyword
+        arguments are passed on to Subscription.
         '''
 
-        return Signal.messages_read(self.signal_cli_call("receive"))
+        return Subscription(self, handler, workers=workers, **kwargs).start()
 
 
-    # pylint: disable=too-many-branches
     @staticmethod
     def messages_read(data):
         '''
+        Parse signal-cli receive output into a list of Envelopes.
         '''
 
-        messages = []
-        data_stream = io.StringIO(data)
+        return parse.messages_read(data)
 
-        current_message = {}
 
-        while True:
-            line = data_stream.readline()
+    @staticmethod
+    def messages_iter(lines):
+        '''
+        Parse signal-cli receive output from an iterable of lines, yielding an
+        Envelope for each message as soon as it is complete.
+        '''
 
-            if line == "":
-                break
+        return parse.messages_iter(lines)
 
-            if not current_message:
-                if line.startswith("Envelope from"):
-                    result = re.match(r"^Envelope from: (\+[0-9]+) \(device: ([0-9]+)\)$", line)
-                    current_message = {
-                        "number": result.group(1),
-                        "device": int(result.group(2)),
-                        "timestamp": None,
-                        "message_timestamp": None,
-                        "receipt": False,
-                        "body": None,
-                    }
-                else:
-                    raise RuntimeError(
-                        "found an 'Envelope from' line "
-                        "while processing a previous message",
-                    )
 
-            else: # current_message is not empty
-                # Empty line signals end of last message.
-                if line == "\n":
-                    messages.append(current_message)
-                    current_message = {}
-
-                elif line.startswith("Timestamp"):
-                    result = re.match(
-                        # pylint: disable=line-too-long
-                        r"^Timestamp: ([0-9]+) \([0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]T[0-9][0-9]:[0-9][0-9]:[0-9][0-9]\.[0-9][0-9][0-9]Z\)$",
-                        line,
-                    )
-                    current_message["timestamp"] = int(result.group(1))
+    @staticmethod
+    def message_from_json(envelope):
+        '''
+        Convert a signal-cli JSON envelope into an Envelope.
+        '''
 
-                elif line.startswith("Message timestamp"):
-                    result = re.match(
-                        # pylint: disable=line-too-long
-                        r"^Message timestamp: ([0-9]+) \([0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]T[0-9][0-9]:[0-9][0-9]:[0-9][0-9]\.[0-9][0-9][0-9]Z\)$",
-                        line,
-                    )
-                    current_message["message_timestamp"] = int(result.group(1))
-
-                elif line.strip("\n") == "Got receipt.":
-                    if current_message["body"] is not None:
-                        # raise a stink
-                        raise RuntimeError(
-                            "current_message[\"body\"] is not None "
-                            "but current_message[\"receipt\"] will be set to True"
-                        )
-                    current_message["receipt"] = True
-
-                elif line.startswith("Body"):
-                    if current_message["receipt"] is True:
-                        raise RuntimeError(
-                            "current_message[\"receipt\"] is True "
-                            "but current_message[\"body\"] will have data put in it"
-                        )
-                    current_message["body"] = re.sub(r"^Body: ", "", line).strip("\n")
-
-        # Finalise last message.
-        if current_message:
-            messages.append(current_message)
-            current_message = {}
+        return parse.envelope_from_json(envelope)
 
-        return messages
+
+    @staticmethod
+    def messages_from_json(envelope):
+        '''
+        Convert a signal-cli JSON envelope into a list of Envelopes, one for each
+        message acknowledged if it is a receipt.
+        '''
+
+        return parse.envelopes_from_json(envelope)
 
 
     #
@@ -208,82 +414,284 @@ class Signal(object):
     #
 
 
+    @staticmethod
+    def send_args(message,
+                  recipient=None, recipients=None,
+                  attachment=None, attachments=None):
+        '''
+        Build the signal-cli arguments for sending a message.
+        '''
+
+        args = ["send", "-m", message]
+        if attachments is not None:
+            args.append("-a")
+            args.extend(attachments)
+        elif attachment is not None:
+            args.extend(["-a", attachment])
+        if recipients is not None:
+            args.extend(recipients)
+        else:
+            args.append(recipient)
+        return args
+
+
+    def send_call(self, message, recipients, attachments=None):
+        '''
+        Send a message to the given recipients in a single signal-cli call, and
+        return its timestamp if signal-cli reports it.
+
+        Raises SignalCLIError if sending failed for any recipient. Recipients
+        which failed with an untrusted identity are invalidated in the identity
+        cache.
+        '''
+
+        try:
+            if self.daemon is not None:
+                params = {
+                    "message": message,
+                    "recipient": list(recipients),
+                }
+                if attachments:
+                    params["attachment"] = list(attachments)
+                result = self.daemon.call("send", params) or {}
+
+                # Report per-recipient failures the same way one-shot signal-cli does.
+                failures = [
+                    "{} for \"{}\"".format(
+                        item.get("type"),
+                        (item.get("recipientAddress") or {}).get("number"),
+                    )
+                    for item in result.get("results", [])
+                    if item.get("type", "SUCCESS") != "SUCCESS"
+                ]
+                if failures:
+                    raise SignalCLIError(
+                        1,
+                        "Failed to send (some) messages:\n{}".format("\n".join(failures)),
+                    )
+
+                return result.get("timestamp")
+
+            stdout, _ = self.signal_cli_call(*Signal.send_args(
+                message,
+                recipients=list(recipients),
+                attachments=attachments or None,
+            ))
+            # Newer versions of signal-cli print the message timestamp.
+            stdout = stdout.strip()
+            if self.output.name == "json" and stdout.startswith("{"):
+                return json.loads(stdout).get("timestamp")
+            return int(stdout) if stdout.isdigit() else None
+
+        except SignalCLIError as err:
+            # Identities of recipients which failed as untrusted have changed.
+            for number, error in Signal.send_errors_read(err.error_message or "").items():
+                if error.startswith(("Untrusted Identity", "IDENTITY_FAILURE")):
+                    self.identities.invalidate(number)
+            raise
+
+
     # pylint: disable=too-many-arguments
-    # pylint: disable=too-many-locals
     def send(self, message,
              recipient=None, recipients=None,
              attachment=None, attachments=None,
-             verify_receipt=False):
+             verify_receipt=False, receipt_timeout=None, check_identity=False):
         '''
         Send a message to Signal to be sent to the given recipients.
 
-        If verify_receipt is True, keep reading messages back until a receipt is found,
-        and return unhandled messages to the caller.
+        If verify_receipt is True, return a ReceiptHandle which is resolved once
+        delivery receipts from all recipients have been received, or fails with
+        ReceiptNotFoundError after receipt_timeout seconds. Receipts are collected
+        in the background; any other messages received while doing so are kept
+        for the next call to receive().
 
-        This method is not blocking if verify_receipt is False, but IS if it is True,
-        and in this case cannot be used concurrently with other threads attempting to
-        run receive() or send().
+        If check_identity is True, raise UntrustedIdentityError without sending
+        if any recipient's identity is known to be untrusted. This is checked
+        against the identity cache, so usually does not need to run signal-cli.
+
+        This method is not blocking, and can be used concurrently with other threads.
         '''
 
-        # TODO: incorporate error checking for this
-        # ./signal-cli -u +61481073042 send -m "Test Message 02" +64220908052
-        # Failed to send (some) messages:
-        # Untrusted Identity for "+64220908052": Untrusted identity key!
+        numbers = recipients if recipients is not None else [recipient]
+
+        if check_identity:
+            untrusted = [number for number in numbers if not self.identities.is_trusted(number)]
+            if untrusted:
+                raise UntrustedIdentityError(untrusted)
+
+        # Start tracking before sending, using an approximate timestamp, so a
+        # receipt can't arrive before we are looking for it.
+        handle = None
+        if verify_receipt:
+            handle = self.receipts.track(
+                int(time.time() * 1000),
+                numbers,
+                timeout=receipt_timeout,
+            )
+
+        try:
+            if attachments is None:
+                attachments = [attachment]
+            attachments = [path for path in attachments if path is not None]
+            timestamp = self.send_call(message, numbers, attachments=attachments)
+        except Exception:
+            if handle is not None:
+                self.receipts.cancel(handle)
+            raise
+
+        if handle is not None and timestamp is not None:
+            self.receipts.update(handle, timestamp)
 
-        # * Allow more than one recipient and attachment to be specified.
-        # * Take a timestamp of when the message was sent, look for the first receipt for
-        #   AFTER this timestamp. This makes sure this method does not get confused when
-        #   previous (unchecked) receipts are found.
+        return handle
 
-        self.lock.acquire(blocking=verify_receipt)
 
-        unhandled_messages = []
+    def send_durable(self, message,
+                     recipient=None, recipients=None,
+                     attachment=None, attachments=None):
+        '''
+        Write a message to the outbound spool, and return the spool IDs of its
+        entries, one per recipient. It is sent in the background, and retried
+        until it succeeds, fails permanently or runs out of attempts; use
+        self.spool.get() to check on it.
+
+        Requires the spool argument to have been given when creating this object.
+        '''
+
+        if self.spool is None:
+            raise ValueError("no outbound spool directory configured")
+
+        if attachments is None:
+            attachments = [attachment]
+        # Absolute, as the spool may be sent from after a restart.
+        attachments = [os.path.abspath(path) for path in attachments if path is not None]
+        return self.spool.enqueue(
+            message,
+            recipients if recipients is not None else [recipient],
+            attachments,
+        )
+
+
+    # pylint: disable=too-many-locals
+    def send_many(self, jobs, batch_size=100, concurrency=4, retries=2):
+        '''
+        Send many messages, and return a SendResult for every recipient of every job.
+
+        jobs is an iterable of SendJob (or (message, recipients[, attachments])
+        tuples), where recipients and attachments are lists, or single strings.
+        Recipients of jobs with the same message and attachment
+        contents are sent to together, in batches of up to batch_size per signal-cli call,
+        with up to concurrency calls running at once. Recipients which failed
+        with a transient error are retried, on their own, up to retries times.
+        '''
+
+        jobs = [SendJob(*job) for job in jobs]
+        # A single recipient or attachment given as a bare string, rather than
+        # a list of them.
+        jobs = [
+            job._replace(
+                recipients=[job.recipients] if isinstance(job.recipients, str) else job.recipients,
+                attachments=[job.attachments] if isinstance(job.attachments, str) else job.attachments,
+            )
+            for job in jobs
+        ]
+
+        # Merge jobs by content, keeping the order recipients were given in.
+        # Attachments are compared by name and content, so copies of the same
+        # file are still only uploaded once per batch.
+        keys = [
+            (job.message, self.attachments.key(job.attachments or ()))
+            for job in jobs
+        ]
+        groups = collections.OrderedDict()
+        paths = {}
+        for job, key in zip(jobs, keys):
+            groups.setdefault(key, collections.OrderedDict()).update(
+                (recipient, None) for recipient in job.recipients
+            )
+            paths.setdefault(
+                key,
+                [path for path in job.attachments or () if path is not None],
+            )
+
+        outcomes = {}
+        pending = [(key, list(recipients)) for key, recipients in groups.items()]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for attempt in range(1, retries + 2):
+                batches = [
+                    (key, recipients[i:i + batch_size])
+                    for key, recipients in pending
+                    for i in range(0, len(recipients), batch_size)
+                ]
+                futures = {
+                    executor.submit(self.send_batch, key[0], batch, paths[key]): (key, batch)
+                    for key, batch in batches
+                }
+
+                retry = collections.OrderedDict()
+                for future in concurrent.futures.as_completed(futures):
+                    key, batch = futures[future]
+                    for recipient, error in future.result().items():
+                        outcomes[(key, recipient)] = (error, attempt)
+                        if error is not None and not Signal.send_error_permanent(error):
+                            retry.setdefault(key, []).append(recipient)
+
+                pending = list(retry.items())
+                if not pending:
+                    break
+
+        results = []
+        for job, key in zip(jobs, keys):
+            for recipient in job.recipients:
+                error, attempts = outcomes[(key, recipient)]
+                results.append(SendResult(job.message, recipient, error is None, error, attempts))
+        return results
+
+
+    def send_batch(self, message, recipients, attachments=None):
+        '''
+        Send a message to recipients in one signal-cli call, and return a dict
+        mapping each recipient to its error, or None if it was sent successfully.
+        '''
 
         try:
-            # Prepare the signal-cli arguments.
-            args = ["send", "-m", message]
-            if attachments is not None:
-                args.append("-a")
-                args.extend(attachments)
-            else:
-                args.extend(["-a", attachment])
-            if recipients is not None:
-                args.extend(recipients)
-            else:
-                args.append(recipient)
-
-            # Get an approximate time we sent the message.
-            timestamp = (datetime.datetime.utcnow() * 1000.0).timestamp()
-
-            # Call signal-cli to send the message.
-            self.signal_cli_call(*args)
-
-            # TODO: Try and find a better way to implement this... if possible.
-            #
-            # Read stored messages from Signal until the "arrival receipt" is found.
-            # Save unrelated messages to be returned to the caller later.
-            #
-            # Look for receipt messages, match up the timestamps. If we have a match,
-            # whoo!
-            if verify_receipt:
-                receipt_verified = False
-                while not receipt_verified:
-                    messages = self.receive_messages_get()
-                    receipts = [message for message in messages if message["receipt"]]
-                    sorted_receipts = sorted(receipts, key=lambda x: x["timestamp"])
-                    for receipt in sorted_receipts:
-                        if receipt["timestamp"] < timestamp:
-                            continue
-                        # If we reach this point, we've found the first receipt
-                        # timestamped AFTER ours, which we may safely assume to be
-                        # receipt for this message.
-                        receipt_verified = True
-                        # TODO: finish
-
-        finally:
-            self.lock.release()
-
-        return unhandled_messages
+            self.send_call(message, recipients, attachments=attachments)
+        except SignalCLIError as err:
+            errors = Signal.send_errors_read(err.error_message or "")
+            if not errors:
+                # Nothing to say which recipients failed, so assume they all did.
+                return {recipient: str(err) for recipient in recipients}
+            return {recipient: errors.get(recipient) for recipient in recipients}
+        except (SignalCLITimeoutError, DaemonError) as err:
+            return {recipient: str(err) for recipient in recipients}
+
+        return {recipient: None for recipient in recipients}
+
+
+    @staticmethod
+    def send_errors_read(data):
+        '''
+        Parse signal-cli "Failed to send (some) messages" output into a dict
+        mapping each failed recipient to its error line.
+        '''
+
+        errors = {}
+
+        for line in io.StringIO(data):
+            result = SEND_ERROR_RE.match(line.strip())
+            if result is not None:
+                errors[result.group(2)] = line.strip()
+
+        return errors
+
+
+    @staticmethod
+    def send_error_permanent(error):
+        '''
+        Return True if a per-recipient send error will not go away by retrying.
+        '''
+
+        return error.startswith(SEND_ERRORS_PERMANENT)
 
 
     #
@@ -291,56 +699,63 @@ class Signal(object):
     #
 
 
-    def safety_number_verify(self):
+    def list_identities(self, number=None):
         '''
+        Fetch the identities signal-cli knows about, or just those of the given
+        number, bypassing the identity cache.
         '''
 
-        # TODO: Locking?
-        # self.lock.acquire(blocking=True)
-        # try:
+        if self.daemon is not None:
+            return [
+                Signal.identity_from_json(identity)
+                for identity in self.daemon.call(
+                    "listIdentities",
+                    {"number": number} if number is not None else None,
+                )
+            ]
+
+        args = ["listIdentities"]
+        if number is not None:
+            args.extend(["-n", number])
+        stdout, _ = self.signal_cli_call(*args)
+        if self.observer is None:
+            return self.output.identities_read(stdout)
+
+        start = time.perf_counter()
+        identities = self.output.identities_read(stdout)
+        self.observer.timing(
+            "parse_seconds",
+            time.perf_counter() - start,
+            {"operation": "listIdentities"},
+        )
+        return identities
 
-        # List identities.
-        identities = Signal.identities_read(self.signal_cli_call("listIdentities"))
 
-        # TODO: Verify.
-        for identity in identities:
-            if identity["status"] == "UNTRUSTED":
-                # Untrusted. What to do in this case?
-                continue
-            elif identity["status"] == "TRUSTED_UNVERIFIED":
-                # Trusted but unverified, needs to be verified with user input?
-                continue
-            elif identity["status"] == "TRUSTED_VERIFIED":
-                # Trusted and verified identity. No need to do anything.
-                continue
+    def safety_number_verify(self):
+        '''
+        Return the identities which are untrusted, e.g. because their identity
+        key has changed, and need verifying.
 
-        # finally:
-        #   self.lock.release()
+        Identities are read from the identity cache, which is refreshed from
+        signal-cli when it has expired.
+        '''
+
+        return self.identities.untrusted()
 
 
     @staticmethod
     def identities_read(data):
         '''
+        Parse signal-cli listIdentities output into a list of Identities.
         '''
 
-        identities = []
-        data_stream = io.StringIO(data)
-
-        while True:
-            line = data_stream.readline()
-
-            if line == "":
-                break
+        return parse.identities_read(data)
 
-            # pylint: disable=line-too-long
-            result = re.match(r"^(\+[0-9]+): (UNTRUSTED|TRUSTED_UNVERIFIED|TRUSTED_VERIFIED) Added: ((Mon|Tue|Wed|Thu|Fri) (Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) [0-9][0-9]? [0-9]{2}:[0-9]{2}:[0-9]{2} [^\s]+ [0-9]+) Fingerprint: ([0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2} [0-9A-Fa-f]{2})  Safety Number: ([0-9]{5} [0-9]{5} [0-9]{5} [0-9]{5} [0-9]{5} [0-9]{5} [0-9]{5} [0-9]{5} [0-9]{5} [0-9]{5} [0-9]{5} [0-9]{5})$", line)
 
-            identities.append({
-                "number": result.group(1),
-                "status": result.group(2),
-                "added_date": result.group(3),
-                "fingerprint": result.group(6),
-                "safety_number": result.group(7),
-            })
+    @staticmethod
+    def identity_from_json(identity):
+        '''
+        Convert a signal-cli JSON identity into an Identity.
+        '''
 
-        return identities
+        return parse.identity_from_json(identity)
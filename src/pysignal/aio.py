@@ -0,0 +1,268 @@
+#
+# Signal Protocol Python library
+# pysignal/aio.py - asyncio client
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+asyncio client, built on asyncio subprocesses.
+
+Requires Python 3.6 or later.
+'''
+
+
+import asyncio
+
+from pysignal import SIGNAL_CLI
+from pysignal import Signal
+from pysignal import parse
+from pysignal.exception import SignalCLIError
+from pysignal.exception import SignalCLITimeoutError
+
+
+class AsyncSignal(object):
+    '''
+    asyncio counterpart to Signal.
+
+    Up to max_concurrency signal-cli processes are run at once. Receiving is
+    serialised per account, as with Signal.
+    '''
+
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, username, signal_cli=SIGNAL_CLI, max_concurrency=16, timeout=60,
+                 output="text"):
+        '''
+        '''
+
+        self.username = username
+        self.signal_cli = signal_cli
+        self.output = parse.output_format(output)
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+
+        # Created on first use, in the loop using them: before Python 3.10,
+        # asyncio primitives are tied to the loop current when they are made.
+        self._loop = None
+        self._lock = None
+        self._semaphore = None
+
+
+    def _loop_primitives(self):
+        '''
+        Create the lock and semaphore for the running loop, if not done yet.
+        '''
+
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._lock = asyncio.Lock()
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+
+    @property
+    def lock(self):
+        '''
+        Lock serialising receives. Only usable from within the running loop.
+        '''
+
+        self._loop_primitives()
+        return self._lock
+
+
+    @property
+    def semaphore(self):
+        '''
+        Semaphore limiting concurrent signal-cli processes. Only usable from
+        within the running loop.
+        '''
+
+        self._loop_primitives()
+        return self._semaphore
+
+
+    #
+    ##
+    #
+
+
+    def signal_cli_args(self, args):
+        '''
+        '''
+
+        process_args = [self.signal_cli, "-u", self.username]
+        process_args.extend(self.output.args)
+        process_args.extend(args)
+        return process_args
+
+
+    async def signal_cli_call(self, *args, timeout=None):
+        '''
+        Run a one-shot signal-cli command, and return its (stdout, stderr).
+
+        The child process is killed if the timeout is reached, or if the calling
+        task is cancelled.
+        '''
+
+        if timeout is None:
+            timeout = self.timeout
+
+        async with self.semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *self.signal_cli_args(args),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                raise SignalCLITimeoutError(timeout)
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+
+        stdout = stdout.decode()
+        stderr = stderr.decode()
+
+        if process.returncode != 0:
+            raise SignalCLIError(process.returncode, stderr)
+
+        return (stdout, stderr)
+
+
+    #
+    ## Receiving methods.
+    #
+
+
+    async def receive(self, timeout=None):
+        '''
+        Receive all unread messages from Signal and return them.
+        '''
+
+        async with self.lock:
+            stdout, _ = await self.signal_cli_call("receive", timeout=timeout)
+
+        return self.output.messages_read(stdout)
+
+
+    # pylint: disable=too-many-branches
+    async def receive_iter(self, timeout=None):
+        '''
+        Receive all unread messages from Signal, yielding each one as soon as
+        signal-cli has finished printing it.
+
+        The timeout applies to the receive as a whole, not to each message.
+        '''
+
+        if timeout is None:
+            timeout = self.timeout
+
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+
+        async with self.lock, self.semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *self.signal_cli_args(["receive"]),
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            # Drain stderr alongside stdout, so signal-cli can't block on it.
+            stderr_task = asyncio.ensure_future(process.stderr.read())
+
+            try:
+                lines = []
+                while True:
+                    try:
+                        line = await asyncio.wait_for(
+                            process.stdout.readline(),
+                            deadline - loop.time(),
+                        )
+                    except asyncio.TimeoutError:
+                        raise SignalCLITimeoutError(timeout)
+
+                    if not line:
+                        break
+
+                    line = line.decode()
+                    lines.append(line)
+
+                    # In text output, an empty line signals end of a message.
+                    # In JSON output, every line is a complete message.
+                    if line == "\n" or self.output.name == "json":
+                        for message in self.output.messages_read("".join(lines)):
+                            yield message
+                        lines = []
+
+                for message in self.output.messages_read("".join(lines)):
+                    yield message
+
+                await process.wait()
+
+            finally:
+                if process.returncode is None:
+                    process.kill()
+                    await process.wait()
+                stderr = (await stderr_task).decode()
+
+        if process.returncode != 0:
+            raise SignalCLIError(process.returncode, stderr)
+
+
+    #
+    ## Sending methods.
+    #
+
+
+    # pylint: disable=too-many-arguments
+    async def send(self, message,
+                   recipient=None, recipients=None,
+                   attachment=None, attachments=None,
+                   timeout=None):
+        '''
+        Send a message to Signal to be sent to the given recipients.
+
+        Sends do not take the receive lock, so many can be in flight at once,
+        limited only by max_concurrency.
+        '''
+
+        await self.signal_cli_call(
+            *Signal.send_args(
+                message,
+                recipient=recipient,
+                recipients=recipients,
+                attachment=attachment,
+                attachments=attachments,
+            ),
+            timeout=timeout,
+        )
+
+
+    #
+    ##
+    #
+
+
+    async def identities(self, timeout=None):
+        '''
+        Return the identities known to signal-cli for this account.
+        '''
+
+        stdout, _ = await self.signal_cli_call("listIdentities", timeout=timeout)
+        return self.output.identities_read(stdout)
@@ -0,0 +1,185 @@
+#
+# Signal Protocol Python library
+# pysignal/attachment.py - content-addressed attachment cache
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Content-addressed attachment cache.
+'''
+
+
+import collections
+import hashlib
+import mimetypes
+import mmap
+import os
+import threading
+
+from pysignal.parse import Record
+
+
+# Files at least this big are hashed through mmap rather than read().
+MMAP_THRESHOLD = 1 << 20
+CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path, chunk_size=CHUNK_SIZE):
+    '''
+    Return the SHA-256 digest of a file, without loading it all into memory.
+    '''
+
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as infile:
+        size = os.fstat(infile.fileno()).st_size
+
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, size, chunk_size):
+                        digest.update(view[offset:offset + chunk_size])
+                finally:
+                    view.release()
+        else:
+            for chunk in iter(lambda: infile.read(chunk_size), b""):
+                digest.update(chunk)
+
+    return digest.digest()
+
+
+class AttachmentPointer(Record):
+    '''
+    Pointer to an uploaded attachment, as carried in a PushMessageContent.
+    '''
+
+    __slots__ = ("id", "content_type", "key")
+
+
+    def __init__(self, attachment_id, content_type, key):
+        '''
+        '''
+
+        self.id = attachment_id # pylint: disable=invalid-name
+        self.content_type = content_type
+        self.key = key
+
+
+class Attachment(Record):
+    '''
+    A local file to be sent as an attachment, with its content digest.
+    '''
+
+    __slots__ = ("path", "content_type", "digest", "size")
+
+
+    def __init__(self, path, content_type, digest, size):
+        '''
+        '''
+
+        self.path = path
+        self.content_type = content_type
+        self.digest = digest
+        self.size = size
+
+
+class AttachmentCache(object):
+    '''
+    Bounded LRU cache of Attachments, keyed by path.
+
+    Files are only hashed again when their size, modification time or inode
+    changes.
+
+    signal-cli uploads attachments itself, and has no way to reuse an earlier
+    upload, so the digest is only used to tell which attachments have the same
+    content, e.g. to send them to many recipients in one signal-cli call. The
+    files handed to signal-cli are always the ones given, as it takes the file
+    name (and from that, the content type) from the path.
+    '''
+
+
+    def __init__(self, max_entries=1024):
+        '''
+        '''
+
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._attachments = collections.OrderedDict() # path -> (stat key, Attachment)
+
+
+    def __len__(self):
+        '''
+        '''
+
+        with self._lock:
+            return len(self._attachments)
+
+
+    @staticmethod
+    def _stat_key(path):
+        '''
+        '''
+
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+
+    def get(self, path):
+        '''
+        Return the Attachment for the file at path, hashing it if it is new or
+        has changed since it was last seen.
+        '''
+
+        abspath = os.path.abspath(path)
+        stat_key = self._stat_key(abspath)
+
+        with self._lock:
+            known = self._attachments.get(abspath)
+            if known is not None and known[0] == stat_key:
+                self._attachments.move_to_end(abspath)
+                return known[1]
+
+        # Hash outside the lock, so other files can be looked up meanwhile.
+        attachment = Attachment(
+            abspath,
+            mimetypes.guess_type(abspath)[0] or "application/octet-stream",
+            file_digest(abspath),
+            stat_key[0],
+        )
+
+        with self._lock:
+            self._attachments[abspath] = (stat_key, attachment)
+            self._attachments.move_to_end(abspath)
+            while len(self._attachments) > self.max_entries:
+                self._attachments.popitem(last=False)
+
+        return attachment
+
+
+    def key(self, paths):
+        '''
+        Return a key for a list of attachment paths, which is the same for any
+        list of files with the same names and contents.
+        '''
+
+        return tuple(
+            (os.path.basename(path), self.get(path).digest)
+            for path in paths
+            if path is not None
+        )
@@ -0,0 +1,379 @@
+#
+# Signal Protocol Python library
+# pysignal/crypt.py - message encryption
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Message encryption with AES-256-GCM, using per-recipient cached sessions.
+
+Requires the cryptography package (pip install pysignal[crypt]).
+
+Each encrypted message is laid out as:
+
+  nonce (12 bytes) || ciphertext || tag (16 bytes)
+
+Each session starts its nonces at a random 96-bit value and counts up from
+there, so nonces never repeat within a session and don't need a random number
+per message. As the starting point is fully random, sessions started again
+with the same key (e.g. after being evicted) are as unlikely to reuse a nonce
+as if every nonce were random.
+'''
+
+
+import collections
+import concurrent.futures
+import itertools
+import os
+import threading
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError: # pragma: no cover
+    AESGCM = None
+
+from pysignal.exception import SessionNotFoundError
+
+
+NONCE_SIZE = 12
+TAG_SIZE = 16
+OVERHEAD = NONCE_SIZE + TAG_SIZE
+
+KEY_SIZE = 32
+KEY_INFO = b"pysignal message key"
+
+_NONCE_MODULUS = 1 << (NONCE_SIZE * 8)
+
+# Batches smaller than this are not worth handing to a thread pool.
+PARALLEL_THRESHOLD = 256
+
+
+def _require_cryptography():
+    '''
+    '''
+
+    if AESGCM is None:
+        raise ImportError("the cryptography package is required for pysignal.crypt")
+
+
+def derive_key(secret, salt=None, info=KEY_INFO):
+    '''
+    Derive a message key from a shared session secret, with HKDF-SHA256.
+    '''
+
+    _require_cryptography()
+
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=KEY_SIZE,
+        salt=salt,
+        info=info,
+        backend=default_backend(),
+    ).derive(secret)
+
+
+class Session(object):
+    '''
+    Encryption context for one recipient: the AESGCM object for its key,
+    set up once, and the nonce sequence.
+    '''
+
+    __slots__ = ("recipient", "aead", "counter")
+
+
+    def __init__(self, recipient, key):
+        '''
+        '''
+
+        self.recipient = recipient
+        self.aead = AESGCM(key)
+        self.counter = itertools.count(int.from_bytes(os.urandom(NONCE_SIZE), "big"))
+
+
+    def nonce(self):
+        '''
+        '''
+
+        return (next(self.counter) % _NONCE_MODULUS).to_bytes(NONCE_SIZE, "big")
+
+
+class SessionCache(object):
+    '''
+    LRU cache of per-recipient Sessions, holding at most max_sessions.
+
+    Sessions are created with add() from a shared secret (or a key). When the
+    cache is full, the least recently used session is evicted; it has to be
+    added again before it can be used.
+    '''
+
+
+    def __init__(self, max_sessions=1024, workers=None):
+        '''
+        workers is the number of threads used for large encrypt_many() and
+        decrypt_many() batches. The AES-GCM primitives release the GIL, so
+        batches can run in parallel. If None, batches run in the calling thread.
+        '''
+
+        _require_cryptography()
+
+        self.max_sessions = max_sessions
+
+        self._lock = threading.Lock()
+        self._sessions = collections.OrderedDict()
+
+        self._executor = None
+        if workers:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._workers = workers or 1
+
+
+    def close(self):
+        '''
+        '''
+
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+    def __len__(self):
+        '''
+        '''
+
+        with self._lock:
+            return len(self._sessions)
+
+
+    #
+    ## Sessions.
+    #
+
+
+    def add(self, recipient, secret=None, key=None):
+        '''
+        Start a session with a recipient, from a shared secret (which is put
+        through derive_key()) or an already derived key. Replaces any existing
+        session.
+        '''
+
+        if key is None:
+            key = derive_key(secret)
+        session = Session(recipient, key)
+
+        with self._lock:
+            self._sessions[recipient] = session
+            self._sessions.move_to_end(recipient)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+        return session
+
+
+    def get(self, recipient):
+        '''
+        Return the session for a recipient.
+
+        Raises SessionNotFoundError if there is none, e.g. because it was evicted.
+        '''
+
+        with self._lock:
+            session = self._sessions.get(recipient)
+            if session is None:
+                raise SessionNotFoundError(recipient)
+            self._sessions.move_to_end(recipient)
+            return session
+
+
+    def evict(self, recipient=None):
+        '''
+        Drop the session for a recipient, or all sessions if None.
+        '''
+
+        with self._lock:
+            if recipient is None:
+                self._sessions.clear()
+            else:
+                self._sessions.pop(recipient, None)
+
+
+    def _sessions_for(self, recipients):
+        '''
+        Look up sessions for many recipients with a single lock acquisition.
+        '''
+
+        sessions = {}
+        with self._lock:
+            for recipient in recipients:
+                if recipient in sessions:
+                    continue
+                session = self._sessions.get(recipient)
+                if session is None:
+                    raise SessionNotFoundError(recipient)
+                self._sessions.move_to_end(recipient)
+                sessions[recipient] = session
+        return sessions
+
+
+    #
+    ## Encryption.
+    #
+
+
+    def encrypt(self, recipient, plaintext, associated_data=None):
+        '''
+        Encrypt one message for a recipient, and return it.
+        '''
+
+        session = self.get(recipient)
+        nonce = session.nonce()
+        return nonce + session.aead.encrypt(nonce, plaintext, associated_data)
+
+
+    def decrypt(self, recipient, data, associated_data=None):
+        '''
+        Decrypt one message from a recipient, and return the plaintext.
+
+        Raises cryptography.exceptions.InvalidTag if the message has been
+        tampered with or was not encrypted with this session's key.
+        '''
+
+        session = self.get(recipient)
+        with memoryview(data) as view:
+            return session.aead.decrypt(
+                view[:NONCE_SIZE].tobytes(),
+                view[NONCE_SIZE:].tobytes(),
+                associated_data,
+            )
+
+
+    def encrypt_many(self, items, out=None, associated_data=None):
+        '''
+        Encrypt many (recipient, plaintext) items.
+
+        The encrypted messages are written one after another into out (a
+        writable buffer), or a new bytearray if None. Return (buffer, offsets),
+        where offsets[i] is the (start, end) of message i in buffer.
+        '''
+
+        items = list(items)
+        sessions = self._sessions_for(recipient for recipient, _ in items)
+
+        offsets = []
+        pos = 0
+        for _, plaintext in items:
+            end = pos + len(plaintext) + OVERHEAD
+            offsets.append((pos, end))
+            pos = end
+
+        if out is None:
+            out = bytearray(pos)
+        elif len(out) < pos:
+            raise ValueError("buffer too small: need {} bytes, have {}".format(pos, len(out)))
+
+        with memoryview(out) as view:
+            self._run(self._encrypt_range, items, sessions, view, offsets, associated_data)
+
+        return (out, offsets)
+
+
+    @staticmethod
+    def _encrypt_range(items, sessions, view, offsets, associated_data, start, stop):
+        '''
+        '''
+
+        for index in range(start, stop):
+            recipient, plaintext = items[index]
+            session = sessions[recipient]
+            nonce = session.nonce()
+            pos, end = offsets[index]
+            view[pos:pos + NONCE_SIZE] = nonce
+            view[pos + NONCE_SIZE:end] = session.aead.encrypt(nonce, plaintext, associated_data)
+
+
+    def decrypt_many(self, items, out=None, associated_data=None):
+        '''
+        Decrypt many (recipient, data) items, as for encrypt_many(), and return
+        (buffer, offsets) of the plaintexts.
+
+        Raises cryptography.exceptions.InvalidTag if any message fails to
+        decrypt.
+        '''
+
+        items = list(items)
+        sessions = self._sessions_for(recipient for recipient, _ in items)
+
+        offsets = []
+        pos = 0
+        for _, data in items:
+            if len(data) < OVERHEAD:
+                raise ValueError("encrypted message too short: {} bytes".format(len(data)))
+            end = pos + len(data) - OVERHEAD
+            offsets.append((pos, end))
+            pos = end
+
+        if out is None:
+            out = bytearray(pos)
+        elif len(out) < pos:
+            raise ValueError("buffer too small: need {} bytes, have {}".format(pos, len(out)))
+
+        with memoryview(out) as view:
+            self._run(self._decrypt_range, items, sessions, view, offsets, associated_data)
+
+        return (out, offsets)
+
+
+    @staticmethod
+    def _decrypt_range(items, sessions, view, offsets, associated_data, start, stop):
+        '''
+        '''
+
+        for index in range(start, stop):
+            recipient, data = items[index]
+            pos, end = offsets[index]
+            data = bytes(data)
+            view[pos:end] = sessions[recipient].aead.decrypt(
+                data[:NONCE_SIZE],
+                data[NONCE_SIZE:],
+                associated_data,
+            )
+
+
+    # pylint: disable=too-many-arguments
+    def _run(self, func, items, sessions, view, offsets, associated_data):
+        '''
+        Run func over the items, split into contiguous chunks across the
+        thread pool if the batch is big enough. Chunks write to disjoint parts
+        of the output buffer.
+        '''
+
+        count = len(items)
+        if self._executor is None or count < PARALLEL_THRESHOLD:
+            func(items, sessions, view, offsets, associated_data, 0, count)
+            return
+
+        chunk = -(-count // self._workers)
+        futures = [
+            self._executor.submit(
+                func, items, sessions, view, offsets, associated_data,
+                start, min(start + chunk, count),
+            )
+            for start in range(0, count, chunk)
+        ]
+        for future in futures:
+            future.result()
@@ -0,0 +1,310 @@
+#
+# Signal Protocol Python library
+# pysignal/daemon.py - persistent signal-cli JSON-RPC backend
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Persistent signal-cli backend.
+
+Runs a single long-lived "signal-cli jsonRpc" process per account, and
+multiplexes requests to it over stdin/stdout using JSON-RPC request IDs.
+'''
+
+
+import concurrent.futures
+import itertools
+import json
+import queue
+import subprocess
+import threading
+import time
+
+from pysignal.exception import SignalCLIError
+from pysignal.exception import DaemonError
+
+
+class SignalDaemon(object):
+    '''
+    A long-lived signal-cli process running in JSON-RPC mode.
+
+    The process is started on first use, and restarted automatically if it exits
+    while the daemon is still open. Requests in flight when the process exits
+    fail with DaemonError.
+
+    Incoming envelopes, which signal-cli pushes as "receive" notifications, are
+    queued until collected with receive().
+    '''
+
+
+    def __init__(self, signal_cli, username, restart_delay=1.0, observer=None):
+        '''
+        observer is an optional pysignal.metrics.Observer, told how long each
+        request takes.
+        '''
+
+        self.signal_cli = signal_cli
+        self.username = username
+        self.restart_delay = restart_delay
+        self.observer = observer
+
+        self.process = None
+        self.restarts = 0
+
+        self.envelopes = queue.Queue()
+
+        self._ids = itertools.count(1)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+
+        self._ready = threading.Event()
+        self._closed = False
+        self._thread = None
+
+
+    #
+    ## Process management.
+    #
+
+
+    def start(self):
+        '''
+        Start the signal-cli process and its reader thread, if not already running.
+        '''
+
+        with self._start_lock:
+            if self._closed:
+                raise DaemonError("daemon has been closed")
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(
+                target=self._run,
+                name="pysignal-daemon-{}".format(self.username),
+                daemon=True,
+            )
+            self._thread.start()
+
+
+    def close(self, timeout=10):
+        '''
+        Stop the signal-cli process. Requests still in flight fail with DaemonError.
+        '''
+
+        with self._start_lock:
+            self._closed = True
+            thread = self._thread
+            process = self.process
+
+        if process is not None:
+            try:
+                # signal-cli exits cleanly when its input is closed.
+                process.stdin.close()
+                process.wait(timeout)
+            except (OSError, subprocess.TimeoutExpired):
+                process.kill()
+                process.wait()
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+
+    def _spawn(self):
+        '''
+        '''
+
+        process = subprocess.Popen(
+            [self.signal_cli, "-u", self.username, "jsonRpc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            bufsize=1,
+        )
+
+        with self._start_lock:
+            self.process = process
+            closed = self._closed
+
+        if closed:
+            process.stdin.close()
+
+        return process
+
+
+    def _run(self):
+        '''
+        Reader thread main loop: (re)spawn the process and dispatch its output.
+        '''
+
+        while not self._closed:
+            try:
+                process = self._spawn()
+            except OSError as err:
+                self._fail_pending(DaemonError("unable to start signal-cli: {}".format(err)))
+                time.sleep(self.restart_delay)
+                continue
+
+            self._ready.set()
+
+            for line in process.stdout:
+                self._dispatch(line)
+
+            self._ready.clear()
+            returncode = process.wait()
+            self._fail_pending(
+                DaemonError("signal-cli exited with return code {}".format(returncode)),
+            )
+
+            if not self._closed:
+                self.restarts += 1
+                if self.observer is not None:
+                    self.observer.count("daemon_restarts", 1, {"returncode": returncode})
+                time.sleep(self.restart_delay)
+
+
+    def _dispatch(self, line):
+        '''
+        '''
+
+        line = line.strip()
+        if not line:
+            return
+
+        try:
+            obj = json.loads(line)
+        except ValueError:
+            # signal-cli occasionally logs to stdout; ignore anything that
+            # isn't a JSON-RPC message.
+            return
+
+        if "id" in obj and obj["id"] is not None:
+            with self._pending_lock:
+                future = self._pending.pop(obj["id"], None)
+            if future is None:
+                return
+            if "error" in obj:
+                error = obj["error"]
+                future.set_exception(
+                    SignalCLIError(error.get("code"), error.get("message")),
+                )
+            else:
+                future.set_result(obj.get("result"))
+
+        elif obj.get("method") == "receive":
+            params = obj.get("params") or {}
+            if "envelope" in params:
+                self.envelopes.put(params["envelope"])
+
+
+    def _fail_pending(self, exception):
+        '''
+        '''
+
+        with self._pending_lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+
+        for future in pending:
+            future.set_exception(exception)
+
+
+    #
+    ## Request methods.
+    #
+
+
+    def call(self, method, params=None, timeout=60):
+        '''
+        Send a JSON-RPC request to signal-cli, and wait for the result.
+
+        This method is thread-safe: concurrent calls are multiplexed over the same
+        process, and matched up with their responses by request ID.
+        '''
+
+        self.start()
+
+        if not self._ready.wait(timeout):
+            raise DaemonError("timeout reached ({} seconds) waiting for signal-cli".format(timeout))
+
+        request_id = next(self._ids)
+        future = concurrent.futures.Future()
+
+        request = {"jsonrpc": "2.0", "method": method, "id": request_id}
+        if params:
+            request["params"] = params
+
+        with self._pending_lock:
+            self._pending[request_id] = future
+
+        try:
+            with self._write_lock:
+                self.process.stdin.write(json.dumps(request) + "\n")
+                self.process.stdin.flush()
+        except (OSError, ValueError) as err:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise DaemonError("unable to write to signal-cli: {}".format(err))
+
+        try:
+            if self.observer is None:
+                return future.result(timeout)
+            start = time.perf_counter()
+            try:
+                return future.result(timeout)
+            finally:
+                self.observer.timing(
+                    "daemon_call_seconds",
+                    time.perf_counter() - start,
+                    {"operation": method},
+                )
+        except concurrent.futures.TimeoutError:
+            with self._pending_lock:
+                self._pending.pop(request_id, None)
+            raise DaemonError(
+                "timeout reached ({} seconds) waiting for '{}' response".format(
+                    timeout,
+                    method,
+                ),
+            )
+
+
+    def receive(self, timeout=None):
+        '''
+        Return all envelopes received so far.
+
+        If timeout is given, wait up to that many seconds for the first envelope
+        to arrive when none are queued.
+        '''
+
+        self.start()
+
+        envelopes = []
+
+        if timeout is not None:
+            try:
+                envelopes.append(self.envelopes.get(timeout=timeout))
+            except queue.Empty:
+                return envelopes
+
+        while True:
+            try:
+                envelopes.append(self.envelopes.get_nowait())
+            except queue.Empty:
+                break
+
+        return envelopes
@@ -40,5 +40,120 @@ class SignalCLIError(SignalException):
         super().__init__("ERROR {}: {}".format(self.returncode, self.error_message))
 
 
+    def __reduce__(self):
+        '''
+        Allow the exception to be pickled, e.g. to pass it between processes.
+        '''
+
+        return (type(self), (self.returncode, self.error_message))
+
+
+class SignalCLITimeoutError(SignalException):
+    '''
+    Raised when signal-cli does not finish within the given timeout.
+    '''
+
+    def __init__(self, timeout, stdout=None, stderr=None):
+        '''
+        '''
+
+        self.timeout = timeout
+        self.stdout = stdout
+        self.stderr = stderr
+        message = "timeout reached ({} seconds)".format(timeout)
+        if stdout is not None or stderr is not None:
+            message = "{}\n\nstdout:\n{}\n\nstderr:\n{}".format(message, stdout, stderr)
+        super().__init__(message)
+
+
+    def __reduce__(self):
+        '''
+        '''
+
+        return (type(self), (self.timeout, self.stdout, self.stderr))
+
+
+class ParseError(SignalException):
+    '''
+    Raised when signal-cli output can't be parsed.
+    '''
+
+    def __init__(self, message, line=None, lineno=None):
+        '''
+        '''
+
+        self.reason = message
+        self.line = line
+        self.lineno = lineno
+        if lineno is not None:
+            message = "line {}: {}: {!r}".format(lineno, message, line)
+        super().__init__(message)
+
+
+    def __reduce__(self):
+        '''
+        '''
+
+        return (type(self), (self.reason, self.line, self.lineno))
+
+
+class MessageDecodeError(SignalException):
+    '''
+    Raised when binary message data can't be decoded.
+    '''
+
+
 class ReceiptNotFoundError(SignalException):
     pass
+
+
+class UntrustedIdentityError(SignalException):
+    '''
+    Raised when refusing to send to recipients with untrusted identities.
+    '''
+
+    def __init__(self, numbers):
+        '''
+        '''
+
+        self.numbers = list(numbers)
+        super().__init__("untrusted identity for {}".format(", ".join(self.numbers)))
+
+
+    def __reduce__(self):
+        '''
+        '''
+
+        return (type(self), (self.numbers,))
+
+
+class SessionNotFoundError(SignalException):
+    '''
+    Raised when there is no encryption session for a recipient.
+    '''
+
+    def __init__(self, recipient):
+        '''
+        '''
+
+        self.recipient = recipient
+        super().__init__("no session for {}".format(recipient))
+
+
+    def __reduce__(self):
+        '''
+        '''
+
+        return (type(self), (self.recipient,))
+
+
+class DaemonError(SignalException):
+    '''
+    Raised when the persistent signal-cli process cannot service a request.
+    '''
+
+
+class PoolError(SignalException):
+    '''
+    Raised when a SignalPool worker process cannot service a request.
+    '''
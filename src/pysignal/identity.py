@@ -0,0 +1,197 @@
+#
+# Signal Protocol Python library
+# pysignal/identity.py - cached identity store
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Cached identity and safety number store.
+'''
+
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+
+class IdentityCache(object):
+    '''
+    Cache of the identities signal-cli knows about, keyed by number.
+
+    The whole cache is refreshed with listIdentities once it is older than ttl
+    seconds. Numbers can also be invalidated individually (for example when a
+    send fails with "Untrusted Identity"), in which case only that number is
+    fetched again. Concurrent callers needing the same refresh share a single
+    in-flight listIdentities call.
+    '''
+
+
+    def __init__(self, signal, ttl=300):
+        '''
+        '''
+
+        self.signal = signal
+        self.ttl = ttl
+
+        self._identities = {} # number -> tuple of Identity
+        self._refreshed = None # time of last full refresh
+        self._stale = {} # number -> invalidation count when it was invalidated
+        self._invalidations = 0
+        self._invalidated_all = 0 # invalidation count of the last full invalidation
+
+        self._lock = threading.Lock()
+        self._inflight = {} # None (full refresh) or number -> Future
+
+
+    #
+    ## Lookups.
+    #
+
+
+    def get(self, number):
+        '''
+        Return the identities for the given number, refreshing them first if
+        they are out of date. A number can have more than one identity, e.g.
+        after it re-registers with a new identity key.
+        '''
+
+        self.update(number)
+
+        with self._lock:
+            return self._identities.get(number, ())
+
+
+    def is_trusted(self, number):
+        '''
+        Return False if any identity key of the given number is untrusted.
+
+        Numbers signal-cli has no identity for yet are considered trusted, as
+        signal-cli trusts new identities on first use.
+        '''
+
+        return all(identity.status != "UNTRUSTED" for identity in self.get(number))
+
+
+    def untrusted(self):
+        '''
+        Return all untrusted identities.
+        '''
+
+        self.update()
+
+        with self._lock:
+            return [
+                identity
+                for identities in self._identities.values()
+                for identity in identities
+                if identity.status == "UNTRUSTED"
+            ]
+
+
+    #
+    ## Refreshing.
+    #
+
+
+    def update(self, number=None):
+        '''
+        Refresh the cache if it has expired, or just the given number if it
+        has been invalidated.
+        '''
+
+        with self._lock:
+            expired = self._refreshed is None or time.monotonic() - self._refreshed >= self.ttl
+            stale = number is not None and number in self._stale
+
+        if expired:
+            self.refresh()
+        elif stale:
+            self.refresh(number)
+
+
+    def invalidate(self, number=None):
+        '''
+        Mark a number, or if None the whole cache, as needing a refresh.
+        '''
+
+        with self._lock:
+            self._invalidations += 1
+            if number is None:
+                self._refreshed = None
+                self._invalidated_all = self._invalidations
+            else:
+                self._stale[number] = self._invalidations
+
+
+    def refresh(self, number=None):
+        '''
+        Fetch the identities of the given number, or all identities if None,
+        from signal-cli, and return them.
+
+        If the same refresh (or a full refresh) is already in flight, wait for
+        it instead of starting another.
+        '''
+
+        with self._lock:
+            future = self._inflight.get(None)
+            if future is None:
+                future = self._inflight.get(number)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._inflight[number] = future
+                # Invalidations from here on may not be reflected in what
+                # signal-cli returns, so must outlive this refresh.
+                invalidations = self._invalidations
+
+        if not owner:
+            identities = future.result()
+            if number is None:
+                return identities
+            return [identity for identity in identities if identity.number == number]
+
+        try:
+            identities = self.signal.list_identities(number)
+        except Exception as err:
+            with self._lock:
+                del self._inflight[number]
+            future.set_exception(err)
+            raise
+
+        by_number = collections.defaultdict(list)
+        for identity in identities:
+            by_number[identity.number].append(identity)
+
+        with self._lock:
+            if number is None:
+                self._identities = {key: tuple(value) for key, value in by_number.items()}
+                if self._invalidated_all <= invalidations:
+                    self._refreshed = time.monotonic()
+                self._stale = {
+                    key: value
+                    for key, value in self._stale.items()
+                    if value > invalidations
+                }
+            else:
+                self._identities[number] = tuple(by_number.get(number, ()))
+                if self._stale.get(number, 0) <= invalidations:
+                    self._stale.pop(number, None)
+            del self._inflight[number]
+
+        future.set_result(identities)
+        return identities
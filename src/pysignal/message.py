@@ -0,0 +1,643 @@
+#
+# Signal Protocol Python library
+# pysignal/message.py - PushMessageContent wire format
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+PushMessageContent encoding and decoding, compatible with the protobuf
+definition used by Signal:
+
+  message PushMessageContent {
+    message AttachmentPointer {
+      optional fixed64 id          = 1;
+      optional string  contentType = 2;
+      optional bytes   key         = 3;
+    }
+    message GroupContext {
+      enum Type { UNKNOWN = 0; UPDATE = 1; DELIVER = 2; QUIT = 3; }
+      optional bytes             id      = 1;
+      optional Type              type    = 2;
+      optional string            name    = 3;
+      repeated string            members = 4;
+      optional AttachmentPointer avatar  = 5;
+    }
+    enum Flags { END_SESSION = 1; }
+    optional string            body        = 1;
+    repeated AttachmentPointer attachments = 2;
+    optional GroupContext      group       = 3;
+    optional uint32            flags       = 4;
+  }
+
+Messages are encoded in two passes: the first works out the exact size, the
+second writes straight into a buffer of that size, so nothing is built up
+piecewise. Decoding works on a memoryview of the input, without copying it.
+'''
+
+
+import base64
+import enum
+import struct
+
+from pysignal.attachment import AttachmentPointer
+from pysignal.exception import MessageDecodeError
+from pysignal.parse import Record
+
+
+# Wire types.
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+
+def _tag(field, wire_type):
+    '''
+    '''
+
+    return (field << 3) | wire_type
+
+
+# Field tags. Every field number is below 16, so each tag is a single byte.
+TAG_ATTACHMENT_ID = _tag(1, FIXED64)
+TAG_ATTACHMENT_CONTENT_TYPE = _tag(2, LENGTH_DELIMITED)
+TAG_ATTACHMENT_KEY = _tag(3, LENGTH_DELIMITED)
+
+TAG_GROUP_ID = _tag(1, LENGTH_DELIMITED)
+TAG_GROUP_TYPE = _tag(2, VARINT)
+TAG_GROUP_NAME = _tag(3, LENGTH_DELIMITED)
+TAG_GROUP_MEMBERS = _tag(4, LENGTH_DELIMITED)
+TAG_GROUP_AVATAR = _tag(5, LENGTH_DELIMITED)
+
+TAG_BODY = _tag(1, LENGTH_DELIMITED)
+TAG_ATTACHMENTS = _tag(2, LENGTH_DELIMITED)
+TAG_GROUP = _tag(3, LENGTH_DELIMITED)
+TAG_FLAGS = _tag(4, VARINT)
+
+_FIXED64 = struct.Struct("<Q")
+
+
+#
+## Primitives.
+#
+
+
+def _varint_size(value):
+    '''
+    '''
+
+    if value < 0x80:
+        return 1
+    return (value.bit_length() + 6) // 7
+
+
+def _text_size(text):
+    '''
+    '''
+
+    return len(text.encode("utf-8"))
+
+
+def _field_size(length):
+    '''
+    Size of a length-delimited field with a single byte tag.
+    '''
+
+    if length < 0x80:
+        return length + 2
+    return length + 1 + _varint_size(length)
+
+
+def _write_varint(buffer, pos, value):
+    '''
+    '''
+
+    while value >= 0x80:
+        buffer[pos] = (value & 0x7F) | 0x80
+        value >>= 7
+        pos += 1
+    buffer[pos] = value
+    return pos + 1
+
+
+def _write_bytes(buffer, pos, tag, data):
+    '''
+    '''
+
+    length = len(data)
+    buffer[pos] = tag
+    if length < 0x80:
+        buffer[pos + 1] = length
+        pos += 2
+    else:
+        pos = _write_varint(buffer, pos + 1, length)
+    end = pos + length
+    buffer[pos:end] = data
+    return end
+
+
+def _write_text(buffer, pos, tag, text):
+    '''
+    '''
+
+    return _write_bytes(buffer, pos, tag, text.encode("utf-8"))
+
+
+def _read_varint(view, pos, end):
+    '''
+    '''
+
+    result = 0
+    shift = 0
+    while pos < end:
+        byte = view[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return (result, pos)
+        shift += 7
+        if shift >= 64:
+            raise MessageDecodeError("varint too long at offset {}".format(pos))
+    raise MessageDecodeError("truncated varint at offset {}".format(pos))
+
+
+def _read_length(view, pos, end):
+    '''
+    Read the length of a length-delimited field, and return its (start, stop).
+    '''
+
+    if pos < end and view[pos] < 0x80:
+        # Fast path for the common single byte length.
+        length = view[pos]
+        pos += 1
+    else:
+        length, pos = _read_varint(view, pos, end)
+    stop = pos + length
+    if stop > end:
+        raise MessageDecodeError("field at offset {} runs past the end of its message".format(pos))
+    return (pos, stop)
+
+
+def _skip(view, pos, end, tag):
+    '''
+    Skip over an unknown field.
+    '''
+
+    wire_type = tag & 0x07
+    if wire_type == VARINT:
+        _, pos = _read_varint(view, pos, end)
+    elif wire_type == FIXED64:
+        pos += 8
+    elif wire_type == LENGTH_DELIMITED:
+        _, pos = _read_length(view, pos, end)
+    elif wire_type == FIXED32:
+        pos += 4
+    else:
+        raise MessageDecodeError("unsupported wire type {} at offset {}".format(wire_type, pos))
+
+    if pos > end:
+        raise MessageDecodeError("field at offset {} runs past the end of its message".format(pos))
+    return pos
+
+
+#
+## AttachmentPointer.
+#
+
+
+def _attachment_size(attachment):
+    '''
+    '''
+
+    size = 0
+    if attachment.id is not None:
+        size += 9
+    if attachment.content_type is not None:
+        size += _field_size(_text_size(attachment.content_type))
+    if attachment.key is not None:
+        size += _field_size(len(attachment.key))
+    return size
+
+
+def _attachment_encode(attachment, buffer, pos):
+    '''
+    '''
+
+    if attachment.id is not None:
+        buffer[pos] = TAG_ATTACHMENT_ID
+        _FIXED64.pack_into(buffer, pos + 1, attachment.id)
+        pos += 9
+    if attachment.content_type is not None:
+        pos = _write_text(buffer, pos, TAG_ATTACHMENT_CONTENT_TYPE, attachment.content_type)
+    if attachment.key is not None:
+        pos = _write_bytes(buffer, pos, TAG_ATTACHMENT_KEY, attachment.key)
+    return pos
+
+
+def _attachment_decode(view, pos, end):
+    '''
+    '''
+
+    attachment_id = content_type = key = None
+
+    while pos < end:
+        tag = view[pos]
+        if tag < 0x80:
+            pos += 1
+        else:
+            tag, pos = _read_varint(view, pos, end)
+        if tag == TAG_ATTACHMENT_ID:
+            if pos + 8 > end:
+                raise MessageDecodeError("truncated attachment id at offset {}".format(pos))
+            attachment_id = _FIXED64.unpack_from(view, pos)[0]
+            pos += 8
+        elif tag == TAG_ATTACHMENT_CONTENT_TYPE:
+            start, pos = _read_length(view, pos, end)
+            content_type = str(view[start:pos], "utf-8")
+        elif tag == TAG_ATTACHMENT_KEY:
+            start, pos = _read_length(view, pos, end)
+            key = view[start:pos].tobytes()
+        else:
+            pos = _skip(view, pos, end, tag)
+
+    return AttachmentPointer(attachment_id, content_type, key)
+
+
+#
+## GroupContext.
+#
+
+
+class GroupContext(Record):
+    '''
+    '''
+
+    class Type(enum.IntEnum):
+        '''
+        '''
+
+        UNKNOWN = 0
+        UPDATE = 1
+        DELIVER = 2
+        QUIT = 3
+
+
+    __slots__ = ("id", "type", "name", "members", "avatar")
+
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, group_id=None, group_type=None, name=None, members=(), avatar=None):
+        '''
+        '''
+
+        self.id = group_id # pylint: disable=invalid-name
+        self.type = group_type
+        self.name = name
+        self.members = tuple(members)
+        self.avatar = avatar
+
+
+    def _size(self):
+        '''
+        '''
+
+        size = 0
+        if self.id is not None:
+            size += _field_size(len(self.id))
+        if self.type is not None:
+            size += 1 + _varint_size(self.type)
+        if self.name is not None:
+            size += _field_size(_text_size(self.name))
+        for member in self.members:
+            size += _field_size(_text_size(member))
+        if self.avatar is not None:
+            size += _field_size(_attachment_size(self.avatar))
+        return size
+
+
+    def _encode(self, buffer, pos):
+        '''
+        '''
+
+        if self.id is not None:
+            pos = _write_bytes(buffer, pos, TAG_GROUP_ID, self.id)
+        if self.type is not None:
+            buffer[pos] = TAG_GROUP_TYPE
+            pos = _write_varint(buffer, pos + 1, self.type)
+        if self.name is not None:
+            pos = _write_text(buffer, pos, TAG_GROUP_NAME, self.name)
+        for member in self.members:
+            pos = _write_text(buffer, pos, TAG_GROUP_MEMBERS, member)
+        if self.avatar is not None:
+            buffer[pos] = TAG_GROUP_AVATAR
+            pos = _write_varint(buffer, pos + 1, _attachment_size(self.avatar))
+            pos = _attachment_encode(self.avatar, buffer, pos)
+        return pos
+
+
+    @classmethod
+    def _decode(cls, view, pos, end):
+        '''
+        '''
+
+        group_id = group_type = name = avatar = None
+        members = []
+
+        while pos < end:
+            tag = view[pos]
+            if tag < 0x80:
+                pos += 1
+            else:
+                tag, pos = _read_varint(view, pos, end)
+            if tag == TAG_GROUP_ID:
+                start, pos = _read_length(view, pos, end)
+                group_id = view[start:pos].tobytes()
+            elif tag == TAG_GROUP_TYPE:
+                value, pos = _read_varint(view, pos, end)
+                try:
+                    group_type = cls.Type(value)
+                except ValueError:
+                    group_type = cls.Type.UNKNOWN
+            elif tag == TAG_GROUP_NAME:
+                start, pos = _read_length(view, pos, end)
+                name = str(view[start:pos], "utf-8")
+            elif tag == TAG_GROUP_MEMBERS:
+                start, pos = _read_length(view, pos, end)
+                members.append(str(view[start:pos], "utf-8"))
+            elif tag == TAG_GROUP_AVATAR:
+                start, pos = _read_length(view, pos, end)
+                avatar = _attachment_decode(view, start, pos)
+            else:
+                pos = _skip(view, pos, end, tag)
+
+        return cls(group_id, group_type, name, members, avatar)
+
+
+#
+## PushMessageContent.
+#
+
+
+class PushMessageContent(Record):
+    '''
+    '''
+
+    class Flags(enum.IntEnum):
+        '''
+        '''
+
+        END_SESSION = 1
+
+
+    AttachmentPointer = AttachmentPointer
+    GroupContext = GroupContext
+
+    __slots__ = ("body", "attachments", "group", "flags")
+
+
+    def __init__(self, body=None, attachments=(), group=None, flags=None):
+        '''
+        '''
+
+        self.body = body
+        self.attachments = tuple(attachments)
+        self.group = group
+        self.flags = flags
+
+
+    def encoded_size(self):
+        '''
+        Return the size of the encoded message, in bytes.
+        '''
+
+        return self._plan()[0]
+
+
+    def _plan(self):
+        '''
+        First encoding pass: return (size, encoded body, attachment sizes,
+        group size), so the second pass doesn't need to work them out again.
+        '''
+
+        size = 0
+
+        body = self.body
+        if body is not None:
+            body = body.encode("utf-8")
+            size += _field_size(len(body))
+
+        attachment_sizes = ()
+        if self.attachments:
+            attachment_sizes = [_attachment_size(attachment) for attachment in self.attachments]
+            for attachment_size in attachment_sizes:
+                size += _field_size(attachment_size)
+
+        group_size = None
+        if self.group is not None:
+            group_size = self.group._size() # pylint: disable=protected-access
+            size += _field_size(group_size)
+
+        if self.flags is not None:
+            size += 1 + _varint_size(self.flags)
+
+        return (size, body, attachment_sizes, group_size)
+
+
+    def encode_into(self, buffer, offset=0):
+        '''
+        Encode the message into a writable buffer (e.g. a bytearray or
+        memoryview) at offset, and return the offset just past it.
+        '''
+
+        plan = self._plan()
+        if offset + plan[0] > len(buffer):
+            raise ValueError("buffer too small: need {} bytes, have {}".format(
+                offset + plan[0],
+                len(buffer),
+            ))
+        return self._encode(buffer, offset, plan)
+
+
+    def _encode(self, buffer, pos, plan):
+        '''
+        Second encoding pass: write the message, as planned by _plan().
+        '''
+
+        _, body, attachment_sizes, group_size = plan
+
+        if body is not None:
+            pos = _write_bytes(buffer, pos, TAG_BODY, body)
+        if attachment_sizes:
+            for attachment, attachment_size in zip(self.attachments, attachment_sizes):
+                buffer[pos] = TAG_ATTACHMENTS
+                pos = _write_varint(buffer, pos + 1, attachment_size)
+                pos = _attachment_encode(attachment, buffer, pos)
+        if group_size is not None:
+            buffer[pos] = TAG_GROUP
+            pos = _write_varint(buffer, pos + 1, group_size)
+            pos = self.group._encode(buffer, pos) # pylint: disable=protected-access
+        if self.flags is not None:
+            buffer[pos] = TAG_FLAGS
+            pos = _write_varint(buffer, pos + 1, self.flags)
+        return pos
+
+
+    def to_bytes(self):
+        '''
+        '''
+
+        plan = self._plan()
+        buffer = bytearray(plan[0])
+        self._encode(buffer, 0, plan)
+        return bytes(buffer)
+
+
+    def to_base64(self):
+        '''
+        '''
+
+        return base64.b64encode(self.to_bytes())
+
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''
+        Decode a message from a bytes-like object.
+
+        Raises MessageDecodeError if the data is not a valid message.
+        '''
+
+        try:
+            with memoryview(data) as view:
+                return cls._decode(view, 0, len(view))
+        except UnicodeDecodeError as err:
+            raise MessageDecodeError("invalid UTF-8 text: {}".format(err))
+
+
+    @classmethod
+    def from_base64(cls, data):
+        '''
+        '''
+
+        return cls.from_bytes(base64.b64decode(data))
+
+
+    @classmethod
+    def _decode(cls, view, pos, end):
+        '''
+        '''
+
+        body = group = flags = None
+        attachments = []
+
+        while pos < end:
+            tag = view[pos]
+            if tag < 0x80:
+                pos += 1
+            else:
+                tag, pos = _read_varint(view, pos, end)
+            if tag == TAG_BODY:
+                start, pos = _read_length(view, pos, end)
+                body = str(view[start:pos], "utf-8")
+            elif tag == TAG_ATTACHMENTS:
+                start, pos = _read_length(view, pos, end)
+                attachments.append(_attachment_decode(view, start, pos))
+            elif tag == TAG_GROUP:
+                start, pos = _read_length(view, pos, end)
+                group = GroupContext._decode(view, start, pos) # pylint: disable=protected-access
+            elif tag == TAG_FLAGS:
+                flags, pos = _read_varint(view, pos, end)
+            else:
+                pos = _skip(view, pos, end, tag)
+
+        return cls(body, attachments, group, flags)
+
+
+#
+## Batches.
+#
+
+
+def encode_many_into(messages, buffer, offset=0):
+    '''
+    Encode messages into a writable buffer at offset, each prefixed with its
+    length as a varint (as protobuf's writeDelimitedTo does), and return the
+    offset just past the last one.
+
+    Raises ValueError, without writing anything, if the buffer is too small.
+    '''
+
+    messages = list(messages)
+    plans = [message._plan() for message in messages] # pylint: disable=protected-access
+    end = offset + sum(_varint_size(plan[0]) + plan[0] for plan in plans)
+    if end > len(buffer):
+        raise ValueError("buffer too small: need {} bytes, have {}".format(end, len(buffer)))
+
+    with memoryview(buffer) as view:
+        _encode_many(messages, plans, view, offset)
+
+    return end
+
+
+def encode_many(messages):
+    '''
+    Encode messages into a single new bytearray, each prefixed with its length.
+    '''
+
+    messages = list(messages)
+    plans = [message._plan() for message in messages] # pylint: disable=protected-access
+    buffer = bytearray(sum(_varint_size(plan[0]) + plan[0] for plan in plans))
+    _encode_many(messages, plans, buffer, 0)
+    return buffer
+
+
+def _encode_many(messages, plans, buffer, pos):
+    '''
+    '''
+
+    for message, plan in zip(messages, plans):
+        size = plan[0]
+        if size < 0x80:
+            buffer[pos] = size
+            pos += 1
+        else:
+            pos = _write_varint(buffer, pos, size)
+        pos = message._encode(buffer, pos, plan) # pylint: disable=protected-access
+
+
+def decode_many(data, offset=0, end=None):
+    '''
+    Decode length-prefixed messages, as written by encode_many(), from a
+    bytes-like object, and return them as a list.
+    '''
+
+    messages = []
+
+    try:
+        with memoryview(data) as view:
+            if end is None:
+                end = len(view)
+            pos = offset
+            while pos < end:
+                start, pos = _read_length(view, pos, end)
+                messages.append(
+                    PushMessageContent._decode(view, start, pos), # pylint: disable=protected-access
+                )
+    except UnicodeDecodeError as err:
+        raise MessageDecodeError("invalid UTF-8 text: {}".format(err))
+
+    return messages
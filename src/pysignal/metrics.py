@@ -0,0 +1,248 @@
+#
+# Signal Protocol Python library
+# pysignal/metrics.py - instrumentation hooks and metrics collection
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Instrumentation hooks and metrics collection.
+
+Pass an Observer as the observer argument to Signal to be told how long each
+part of an operation takes. When no observer is set, the hot paths skip all
+instrumentation.
+
+Timings reported:
+  spawn_seconds         starting a signal-cli process
+  wait_seconds          waiting for a signal-cli process to exit
+  parse_seconds         parsing signal-cli output
+  lock_wait_seconds     waiting to acquire the receive lock
+  receipt_wait_seconds  from sending a message to receiving all its receipts
+  daemon_call_seconds   waiting for a response from the signal-cli daemon
+  handler_queue_seconds     a received message waiting for a subscription handler
+  subscription_lag_seconds  from a message being sent to its handler starting
+  send_queue_wait_seconds   a send waiting in a SendScheduler, labelled by priority
+
+Counts reported:
+  calls                 signal-cli invocations
+  errors                failed invocations, labelled by returncode
+  stdout_bytes          signal-cli standard output (decoded characters)
+  stderr_bytes          signal-cli standard error (decoded characters)
+  daemon_restarts       signal-cli daemon exits, labelled by returncode
+
+Metrics are labelled with the operation (signal-cli command) they belong to,
+except for receipt_wait_seconds, the subscription and scheduler timings and
+daemon_restarts.
+'''
+
+
+import bisect
+import collections
+import threading
+
+
+# Histogram bucket upper bounds, in seconds.
+DEFAULT_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+
+class Observer(object):
+    '''
+    Base class for instrumentation observers. Both methods do nothing by default.
+    '''
+
+
+    def timing(self, name, seconds, labels):
+        '''
+        Record a duration, in seconds.
+        '''
+
+        pass
+
+
+    def count(self, name, value, labels):
+        '''
+        Add value to a counter.
+        '''
+
+        pass
+
+
+class Histogram(object):
+    '''
+    '''
+
+    __slots__ = ("buckets", "counts", "total", "count")
+
+
+    def __init__(self, buckets):
+        '''
+        '''
+
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+
+    def add(self, value):
+        '''
+        '''
+
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+
+class MetricsCollector(Observer):
+    '''
+    In-memory observer, keeping counters and latency histograms.
+    '''
+
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix="pysignal"):
+        '''
+        '''
+
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+
+        self._lock = threading.Lock()
+        self._histograms = collections.defaultdict(dict) # name -> labels -> Histogram
+        self._counters = collections.defaultdict(collections.Counter) # name -> labels -> value
+
+
+    def timing(self, name, seconds, labels):
+        '''
+        '''
+
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histograms = self._histograms[name]
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram(self.buckets)
+            histogram.add(seconds)
+
+
+    def count(self, name, value, labels):
+        '''
+        '''
+
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._counters[name][key] += value
+
+
+    def reset(self):
+        '''
+        '''
+
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+    def snapshot(self):
+        '''
+        Return the current metrics as a dict:
+
+          {"timings": {name: [{"labels": {...}, "count": n, "sum": s,
+                               "buckets": {upper bound: cumulative count}}]},
+           "counters": {name: [{"labels": {...}, "value": n}]}}
+        '''
+
+        with self._lock:
+            timings = {
+                name: [
+                    {
+                        "labels": dict(key),
+                        "count": histogram.count,
+                        "sum": histogram.total,
+                        "buckets": dict(zip(
+                            self.buckets + (float("inf"),),
+                            _cumulative(histogram.counts),
+                        )),
+                    }
+                    for key, histogram in sorted(histograms.items())
+                ]
+                for name, histograms in self._histograms.items()
+            }
+            counters = {
+                name: [
+                    {"labels": dict(key), "value": value}
+                    for key, value in sorted(values.items())
+                ]
+                for name, values in self._counters.items()
+            }
+
+        return {"timings": timings, "counters": counters}
+
+
+    def prometheus(self):
+        '''
+        Return the current metrics in the Prometheus text exposition format.
+        '''
+
+        lines = []
+        snapshot = self.snapshot()
+
+        for name, series in sorted(snapshot["timings"].items()):
+            metric = "{}_{}".format(self.prefix, name)
+            lines.append("# TYPE {} histogram".format(metric))
+            for item in series:
+                for bound, count in item["buckets"].items():
+                    labels = dict(item["labels"])
+                    labels["le"] = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append("{}_bucket{} {}".format(metric, _labels(labels), count))
+                lines.append("{}_sum{} {!r}".format(metric, _labels(item["labels"]), item["sum"]))
+                lines.append("{}_count{} {}".format(metric, _labels(item["labels"]), item["count"]))
+
+        for name, series in sorted(snapshot["counters"].items()):
+            metric = "{}_{}_total".format(self.prefix, name)
+            lines.append("# TYPE {} counter".format(metric))
+            for item in series:
+                lines.append("{}{} {}".format(metric, _labels(item["labels"]), item["value"]))
+
+        return "\n".join(lines) + "\n"
+
+
+def _cumulative(counts):
+    '''
+    '''
+
+    total = 0
+    for count in counts:
+        total += count
+        yield total
+
+
+def _labels(labels):
+    '''
+    Format labels for the Prometheus text format.
+    '''
+
+    if not labels:
+        return ""
+
+    return "{{{}}}".format(",".join(
+        '{}="{}"'.format(
+            key,
+            str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'),
+        )
+        for key, value in sorted(labels.items())
+    ))
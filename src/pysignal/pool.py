@@ -0,0 +1,370 @@
+#
+# Signal Protocol Python library
+# pysignal/pool.py - multi-account client pool
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Multi-account client pool, sharding accounts across worker processes.
+'''
+
+
+import collections
+import concurrent.futures
+import itertools
+import multiprocessing
+import pickle
+import queue
+import threading
+import zlib
+
+from pysignal import SIGNAL_CLI
+from pysignal import Signal
+from pysignal.exception import PoolError
+
+
+# Signal methods which can be called through the pool. Their arguments and
+# results must be picklable.
+POOL_METHODS = frozenset((
+    "send",
+    "send_many",
+    "receive",
+    "safety_number_verify",
+))
+
+
+def _account_loop(signal, requests, results):
+    '''
+    Run requests for one account, in order, in a worker process.
+    '''
+
+    try:
+        for request_id, method, args, kwargs in iter(requests.get, None):
+            try:
+                payload = (True, getattr(signal, method)(*args, **kwargs))
+            except Exception as err: # pylint: disable=broad-except
+                payload = (False, err)
+
+            try:
+                data = pickle.dumps(payload)
+            except Exception as err: # pylint: disable=broad-except
+                data = pickle.dumps((False, PoolError("unable to return result: {}".format(err))))
+
+            results.put((request_id, data))
+    finally:
+        signal.close()
+
+
+def _worker(signal_cli, signal_kwargs, requests, results):
+    '''
+    Worker process main loop.
+
+    Each account gets its own thread and queue, so requests for one account run
+    in order while different accounts run in parallel.
+    '''
+
+    queues = {}
+    threads = []
+
+    for request_id, username, method, args, kwargs in iter(requests.get, None):
+        if username not in queues:
+            queues[username] = queue.Queue()
+            thread = threading.Thread(
+                target=_account_loop,
+                args=(
+                    Signal(username, signal_cli=signal_cli, **signal_kwargs),
+                    queues[username],
+                    results,
+                ),
+                name="pysignal-pool-{}".format(username),
+            )
+            thread.start()
+            threads.append(thread)
+
+        queues[username].put((request_id, method, args, kwargs))
+
+    # Shutting down: let every account finish what it has queued.
+    for account_queue in queues.values():
+        account_queue.put(None)
+    for thread in threads:
+        thread.join()
+
+
+class SignalPool(object):
+    '''
+    Manages Signal clients for many accounts, spread across worker processes.
+
+    Each account is always handled by the same worker, chosen by hashing its
+    number, so operations on one account run in the order they were submitted.
+    Operations return concurrent.futures.Future objects.
+
+    If a worker process dies, requests queued on it fail with PoolError and the
+    worker is restarted.
+    '''
+
+
+    def __init__(self, workers=4, signal_cli=SIGNAL_CLI, **signal_kwargs):
+        '''
+        signal_kwargs are passed on to Signal() when creating each account's client.
+        '''
+
+        self.signal_cli = signal_cli
+        self.signal_kwargs = signal_kwargs
+
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+
+        self._pending = {} # request_id -> (future, username, worker index)
+        self._counts = collections.defaultdict(collections.Counter)
+        self._restarts = [0] * workers
+
+        self._results = multiprocessing.Queue()
+        self._requests = [multiprocessing.Queue() for _ in range(workers)]
+        self._processes = [self._spawn(index) for index in range(workers)]
+
+        self._collector = threading.Thread(
+            target=self._collect,
+            name="pysignal-pool-collector",
+            daemon=True,
+        )
+        self._collector.start()
+
+
+    def _spawn(self, index):
+        '''
+        '''
+
+        process = multiprocessing.Process(
+            target=_worker,
+            args=(self.signal_cli, self.signal_kwargs, self._requests[index], self._results),
+            name="pysignal-pool-worker-{}".format(index),
+            daemon=True,
+        )
+        process.start()
+        return process
+
+
+    def worker_for(self, username):
+        '''
+        Return the index of the worker process handling the given account.
+        '''
+
+        return zlib.crc32(username.encode("utf-8")) % len(self._processes)
+
+
+    #
+    ## Requests.
+    #
+
+
+    def call(self, username, method, *args, **kwargs):
+        '''
+        Call a Signal method for the given account in its worker process, and
+        return a Future for the result.
+        '''
+
+        if method not in POOL_METHODS:
+            raise ValueError("method '{}' can't be called through a SignalPool".format(method))
+        if method == "send" and kwargs.get("verify_receipt"):
+            raise ValueError("verify_receipt is not supported through a SignalPool")
+
+        future = concurrent.futures.Future()
+        index = self.worker_for(username)
+
+        with self._lock:
+            if self._closed:
+                raise PoolError("pool has been closed")
+            request_id = next(self._ids)
+            self._pending[request_id] = (future, username, index)
+            self._counts[username]["submitted"] += 1
+            self._requests[index].put((request_id, username, method, args, kwargs))
+
+        return future
+
+
+    def send(self, username, *args, **kwargs):
+        '''
+        '''
+
+        return self.call(username, "send", *args, **kwargs)
+
+
+    def send_many(self, username, *args, **kwargs):
+        '''
+        '''
+
+        return self.call(username, "send_many", *args, **kwargs)
+
+
+    def receive(self, username):
+        '''
+        '''
+
+        return self.call(username, "receive")
+
+
+    def _collect(self):
+        '''
+        Collector thread: resolve futures from worker results, and watch for
+        worker processes that have died.
+        '''
+
+        while True:
+            try:
+                self._resolve(*self._results.get(timeout=0.5))
+            except queue.Empty:
+                if self._check_workers():
+                    return
+
+
+    def _resolve(self, request_id, data):
+        '''
+        '''
+
+        with self._lock:
+            entry = self._pending.pop(request_id, None)
+        if entry is None:
+            return
+
+        future, username, _ = entry
+        try:
+            success, value = pickle.loads(data)
+        except Exception as err: # pylint: disable=broad-except
+            success, value = False, PoolError("unable to read result: {}".format(err))
+
+        with self._lock:
+            self._counts[username]["completed" if success else "errors"] += 1
+
+        if success:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+
+    def _check_workers(self):
+        '''
+        Fail the requests of dead workers, restarting them unless closing.
+        Return True once the pool is closed and has nothing left in flight.
+        '''
+
+        failed = []
+
+        # Results written by a worker just before it exited may still be queued.
+        if not all(process.is_alive() for process in self._processes):
+            while True:
+                try:
+                    self._resolve(*self._results.get_nowait())
+                except queue.Empty:
+                    break
+
+        with self._lock:
+            for index, process in enumerate(self._processes):
+                if process.is_alive():
+                    continue
+                for request_id, (future, username, worker) in list(self._pending.items()):
+                    if worker == index:
+                        del self._pending[request_id]
+                        self._counts[username]["errors"] += 1
+                        failed.append(future)
+                if not self._closed:
+                    self._restarts[index] += 1
+                    self._requests[index] = multiprocessing.Queue()
+                    self._processes[index] = self._spawn(index)
+
+            done = self._closed and not self._pending
+
+        for future in failed:
+            future.set_exception(PoolError("worker process exited"))
+
+        return done
+
+
+    #
+    ## Status.
+    #
+
+
+    def stats(self):
+        '''
+        Return aggregate health and queue depth statistics for the pool.
+        '''
+
+        with self._lock:
+            queued = collections.Counter(worker for _, _, worker in self._pending.values())
+            accounts = {}
+            for username, counts in self._counts.items():
+                accounts[username] = {
+                    "worker": self.worker_for(username),
+                    "queued": counts["submitted"] - counts["completed"] - counts["errors"],
+                    "completed": counts["completed"],
+                    "errors": counts["errors"],
+                }
+            workers = [
+                {
+                    "index": index,
+                    "pid": process.pid,
+                    "alive": process.is_alive(),
+                    "restarts": self._restarts[index],
+                    "queued": queued[index],
+                }
+                for index, process in enumerate(self._processes)
+            ]
+
+        return {
+            "healthy": all(worker["alive"] for worker in workers),
+            "queued": sum(queued.values()),
+            "workers": workers,
+            "accounts": accounts,
+        }
+
+
+    def close(self, timeout=None):
+        '''
+        Shut down the pool. Requests already submitted, including in-flight
+        sends, are completed before the worker processes exit.
+        '''
+
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for requests in self._requests:
+                requests.put(None)
+            processes = list(self._processes)
+
+        for process in processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+        self._collector.join(timeout)
+
+
+    def __enter__(self):
+        '''
+        '''
+
+        return self
+
+
+    def __exit__(self, *exc_info):
+        '''
+        '''
+
+        self.close()
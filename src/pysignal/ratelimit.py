@@ -0,0 +1,494 @@
+#
+# Signal Protocol Python library
+# pysignal/ratelimit.py - outbound rate limiting and scheduling
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Outbound rate limiting and priority scheduling.
+'''
+
+
+import collections
+import concurrent.futures
+import itertools
+import re
+import threading
+import time
+
+from pysignal.exception import SignalCLIError
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+# signal-cli reports server-side rate limiting as a RateLimitException, or
+# an HTTP 413/429 status.
+RATE_LIMIT_RE = re.compile(r"rate ?limit|\b413\b|\b429\b", re.IGNORECASE)
+
+# How many queued sends per priority lane are looked at when searching for
+# one which can go now.
+SCAN_LIMIT = 100
+
+# Number of per-recipient buckets kept before idle ones are dropped.
+MAX_BUCKETS = 10000
+
+# Seconds to wait before dispatching again after an unexpected error.
+DISPATCH_ERROR_WAIT = 1.0
+
+
+class TokenBucket(object):
+    '''
+    Token bucket: rate tokens per second, holding at most burst.
+    '''
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+
+    def __init__(self, rate, burst, now):
+        '''
+        '''
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+
+    def delay(self, now, cost=1, factor=1.0):
+        '''
+        Return how long until cost tokens are available, with the rate scaled
+        by factor. Costs above burst only need a full bucket.
+        '''
+
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate * factor)
+        self.updated = now
+
+        needed = min(cost, self.burst)
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / (self.rate * factor)
+
+
+    def take(self, cost=1):
+        '''
+        '''
+
+        self.tokens -= cost
+
+
+class ScheduledSend(object):
+    '''
+    '''
+
+    __slots__ = (
+        "priority", "recipients", "args", "kwargs", "future", "queued", "attempts", "failed",
+    )
+
+
+    def __init__(self, priority, recipients, args, kwargs, queued):
+        '''
+        '''
+
+        self.priority = priority
+        self.recipients = recipients
+        self.args = args
+        self.kwargs = kwargs
+        self.future = concurrent.futures.Future()
+        self.queued = queued
+        self.attempts = 0
+        self.failed = {} # recipient -> error, for those not being retried
+
+
+class SendScheduler(object):
+    '''
+    Rate-limited, prioritised queue in front of Signal.send().
+
+    Sends are limited by a token bucket for the account (account_rate
+    messages per second per recipient, bursting to account_burst) and one for
+    each recipient. A rate of None means unlimited. Sends which would exceed
+    a limit wait in the queue, rather than spawning signal-cli only for the
+    server to refuse them.
+
+    Higher priority sends go first, but a send held up by its recipient's
+    limit doesn't hold up sends to other recipients.
+
+    When signal-cli reports that the server is rate limiting, all rates are
+    multiplied by slowdown (down to min_factor), and the send is queued again
+    for the recipients which were rate limited, up to retries times. Each
+    successful send raises the rates again by recovery, back up to the
+    configured rates.
+    '''
+
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, signal,
+                 account_rate=10.0, account_burst=20,
+                 recipient_rate=1.0, recipient_burst=5,
+                 workers=4, retries=3,
+                 slowdown=0.5, recovery=0.05, min_factor=0.05):
+        '''
+        '''
+
+        self.signal = signal
+        self.account_rate = account_rate
+        self.account_burst = account_burst
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.retries = retries
+        self.slowdown = slowdown
+        self.recovery = recovery
+        self.min_factor = min_factor
+
+        self.factor = 1.0
+
+        now = time.monotonic()
+        self._account = TokenBucket(account_rate, account_burst, now) if account_rate else None
+        self._recipients = {}
+
+        self._lanes = [collections.deque() for _ in PRIORITIES]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._stopped = False
+        self._cancel = False
+
+        self._counts = collections.Counter()
+        self.last_error = None
+        self._waits = {priority: [0, 0.0, 0.0] for priority in PRIORITIES} # count, total, max
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self._thread = threading.Thread(
+            target=self._run,
+            name="pysignal-scheduler-{}".format(signal.username),
+            daemon=True,
+        )
+        self._thread.start()
+
+
+    #
+    ## Submitting.
+    #
+
+
+    # pylint: disable=too-many-arguments
+    def send(self, message,
+             recipient=None, recipients=None,
+             attachment=None, attachments=None,
+             priority=PRIORITY_NORMAL, **kwargs):
+        '''
+        Queue a message to be sent with Signal.send(), and return a Future for
+        its result. Other keyword arguments are passed on to Signal.send().
+        '''
+
+        if priority not in PRIORITIES:
+            raise ValueError("invalid priority: {}".format(priority))
+
+        numbers = tuple(recipients) if recipients is not None else (recipient,)
+        kwargs.update(
+            recipients=list(numbers),
+            attachment=attachment,
+            attachments=attachments,
+        )
+        item = ScheduledSend(priority, numbers, (message,), kwargs, time.monotonic())
+
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("scheduler has been closed")
+            self._lanes[priority].append(item)
+            self._counts["submitted"] += 1
+            self._wakeup.notify()
+
+        return item.future
+
+
+    #
+    ## Scheduling.
+    #
+
+
+    def _bucket(self, number, now):
+        '''
+        '''
+
+        bucket = self._recipients.get(number)
+        if bucket is None:
+            bucket = self._recipients[number] = TokenBucket(
+                self.recipient_rate,
+                self.recipient_burst,
+                now,
+            )
+        return bucket
+
+
+    def _prune(self, now):
+        '''
+        Drop recipient buckets which have refilled, as they are the same as new ones.
+        '''
+
+        for number, bucket in list(self._recipients.items()):
+            if bucket.delay(now, bucket.burst, self.factor) == 0.0:
+                del self._recipients[number]
+
+
+    def _next(self, now):
+        '''
+        Find the first queued send, in priority order, which is allowed to go
+        now, take its tokens and return (send, None). If nothing can go yet,
+        return (None, seconds until something might).
+        '''
+
+        wait = None
+
+        # Pruning here, rather than while looking at a send's recipients, means
+        # buckets can't be dropped between checking them and taking from them.
+        if len(self._recipients) >= MAX_BUCKETS:
+            self._prune(now)
+
+        for lane in self._lanes:
+            for index, item in enumerate(itertools.islice(lane, SCAN_LIMIT)):
+                cost = len(item.recipients)
+                delay = 0.0
+                if self._account is not None:
+                    delay = self._account.delay(now, cost, self.factor)
+                buckets = ()
+                if self.recipient_rate:
+                    buckets = [self._bucket(number, now) for number in item.recipients]
+                    for bucket in buckets:
+                        delay = max(delay, bucket.delay(now, 1, self.factor))
+
+                if delay == 0.0:
+                    del lane[index]
+                    if self._account is not None:
+                        self._account.take(cost)
+                    for bucket in buckets:
+                        bucket.take()
+                    return (item, None)
+
+                wait = delay if wait is None else min(wait, delay)
+
+        return (None, wait)
+
+
+    def _run(self):
+        '''
+        Dispatcher thread main loop.
+        '''
+
+        observer = self.signal.observer
+
+        while True:
+            with self._lock:
+                while True:
+                    if self._cancel or (self._stopped and not any(self._lanes)):
+                        return
+                    now = time.monotonic()
+                    try:
+                        item, wait = self._next(now)
+                    except Exception as err: # pylint: disable=broad-except
+                        # Keep dispatching, or every queued send would hang.
+                        self._counts["dispatch_errors"] += 1
+                        self.last_error = err
+                        item, wait = None, DISPATCH_ERROR_WAIT
+                    if item is not None:
+                        break
+                    self._wakeup.wait(wait)
+
+                waited = now - item.queued
+                stats = self._waits[item.priority]
+                stats[0] += 1
+                stats[1] += waited
+                stats[2] = max(stats[2], waited)
+                self._counts["dispatched"] += 1
+
+            if observer is not None:
+                observer.timing(
+                    "send_queue_wait_seconds",
+                    waited,
+                    {"priority": item.priority},
+                )
+
+            self._executor.submit(self._send, item)
+
+
+    def _send(self, item):
+        '''
+        '''
+
+        item.attempts += 1
+
+        try:
+            result = self.signal.send(*item.args, **item.kwargs)
+        except SignalCLIError as err:
+            error_message = err.error_message or ""
+            if RATE_LIMIT_RE.search(error_message):
+                limited, failed = self._rate_limited(item, error_message)
+                with self._lock:
+                    self._counts["rate_limited"] += 1
+                    self.factor = max(self.min_factor, self.factor * self.slowdown)
+                    # Spend what is in the bucket, so the slowdown is felt now.
+                    if self._account is not None:
+                        self._account.tokens = min(self._account.tokens, 0.0)
+                    if item.attempts <= self.retries and not self._cancel:
+                        # Only send again to recipients which didn't get it.
+                        item.failed.update(failed)
+                        item.recipients = tuple(limited)
+                        item.kwargs["recipients"] = list(limited)
+                        item.queued = time.monotonic()
+                        self._lanes[item.priority].appendleft(item)
+                        self._wakeup.notify()
+                        return
+            self._finish(item, error=err)
+            return
+        except Exception as err: # pylint: disable=broad-except
+            self._finish(item, error=err)
+            return
+
+        with self._lock:
+            self.factor = min(1.0, self.factor + self.recovery)
+        self._finish(item, result=result)
+
+
+    def _rate_limited(self, item, error_message):
+        '''
+        Split the recipients of a rate-limited send into those which were rate
+        limited, and a dict of those which failed for some other reason. The
+        rest were sent to.
+
+        If signal-cli doesn't say which recipients were rate limited, all of
+        them are assumed to have been.
+        '''
+
+        errors = self.signal.send_errors_read(error_message)
+        limited = [
+            number
+            for number in item.recipients
+            if number in errors and RATE_LIMIT_RE.search(errors[number])
+        ]
+        if not limited:
+            return (list(item.recipients), {})
+
+        failed = {
+            number: error
+            for number, error in errors.items()
+            if number in item.recipients and number not in limited
+        }
+        return (limited, failed)
+
+
+    def _finish(self, item, result=None, error=None):
+        '''
+        Resolve a send's Future. If some recipients failed on an earlier
+        attempt, it fails with a SignalCLIError listing them.
+        '''
+
+        if item.failed and (error is None or isinstance(error, SignalCLIError)):
+            lines = list(item.failed.values())
+            if error is not None:
+                errors = self.signal.send_errors_read(error.error_message or "")
+                lines.extend(errors.values() if errors else [error.error_message])
+            error = SignalCLIError(
+                1,
+                "Failed to send (some) messages:\n{}".format("\n".join(lines)),
+            )
+
+        with self._lock:
+            self._counts["completed" if error is None else "errors"] += 1
+
+        if error is None:
+            item.future.set_result(result)
+        else:
+            item.future.set_exception(error)
+
+
+    #
+    ## Status.
+    #
+
+
+    def stats(self):
+        '''
+        Return queue depths, send counts, the current rate factor, and queue
+        wait times (in seconds) for each priority.
+        '''
+
+        with self._lock:
+            return {
+                "queued": {priority: len(self._lanes[priority]) for priority in PRIORITIES},
+                "factor": self.factor,
+                "submitted": self._counts["submitted"],
+                "dispatched": self._counts["dispatched"],
+                "completed": self._counts["completed"],
+                "errors": self._counts["errors"],
+                "rate_limited": self._counts["rate_limited"],
+                "dispatch_errors": self._counts["dispatch_errors"],
+                "wait": {
+                    priority: {
+                        "count": count,
+                        "mean": total / count if count else None,
+                        "max": longest,
+                    }
+                    for priority, (count, total, longest) in self._waits.items()
+                },
+            }
+
+
+    def close(self, cancel=False):
+        '''
+        Stop the scheduler. Queued sends are still sent, at the configured
+        rates, unless cancel is True, in which case they are cancelled.
+        '''
+
+        with self._lock:
+            self._stopped = True
+            self._cancel = cancel
+            cancelled = []
+            if cancel:
+                for lane in self._lanes:
+                    cancelled.extend(lane)
+                    lane.clear()
+            self._wakeup.notify()
+
+        for item in cancelled:
+            item.future.cancel()
+
+        self._thread.join()
+        self._executor.shutdown(wait=True)
+
+        # Rate-limited sends queued again while shutting down.
+        with self._lock:
+            for lane in self._lanes:
+                cancelled.extend(lane)
+                lane.clear()
+        for item in cancelled:
+            item.future.cancel()
+
+
+    def __enter__(self):
+        '''
+        '''
+
+        return self
+
+
+    def __exit__(self, *exc_info):
+        '''
+        '''
+
+        self.close()
@@ -0,0 +1,408 @@
+#
+# Signal Protocol Python library
+# pysignal/receipt.py - delivery receipt tracking
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Delivery receipt tracking.
+'''
+
+
+import collections
+import concurrent.futures
+import itertools
+import queue
+import threading
+import time
+
+from pysignal.exception import ReceiptNotFoundError
+
+
+class ReceiptHandle(object):
+    '''
+    Handle for a sent message, resolved once every recipient has sent back a
+    delivery receipt, or failed with ReceiptNotFoundError once its deadline passes.
+    '''
+
+
+    def __init__(self, handle_id, timestamp, recipients, deadline):
+        '''
+        '''
+
+        self.id = handle_id # pylint: disable=invalid-name
+        self.timestamp = timestamp
+        self.recipients = frozenset(recipients)
+        self.outstanding = set(recipients)
+        self.deadline = deadline
+        self.created = time.monotonic()
+
+        self.future = concurrent.futures.Future()
+
+
+    def done(self):
+        '''
+        '''
+
+        return self.future.done()
+
+
+    def wait(self, timeout=None):
+        '''
+        Block until receipts from all recipients have been found.
+
+        Raises ReceiptNotFoundError if the receipt deadline passes first, or if
+        timeout seconds elapse.
+        '''
+
+        try:
+            self.future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise ReceiptNotFoundError(
+                "no receipt for message {} from {} within {} seconds".format(
+                    self.timestamp,
+                    ", ".join(sorted(self.outstanding)),
+                    timeout,
+                ),
+            )
+
+
+    def add_done_callback(self, callback):
+        '''
+        Call callback(handle) once the handle is resolved or has expired.
+        '''
+
+        self.future.add_done_callback(lambda future: callback(self))
+
+
+class ReceiptTracker(object):
+    '''
+    Matches incoming delivery receipts to sent messages.
+
+    While any sends are awaiting receipts, a background thread polls the Signal
+    instance for messages. Receipts are matched against outstanding handles,
+    first exactly by (sender, timestamp), then to the oldest outstanding message
+    to that sender sent before the receipt. Everything else, including receipts
+    that match nothing, is put on the inbound queue for receive() to return.
+    '''
+
+
+    def __init__(self, signal, poll_interval=1.0, receipt_timeout=300):
+        '''
+        '''
+
+        self.signal = signal
+        self.poll_interval = poll_interval
+        self.receipt_timeout = receipt_timeout
+
+        self.inbound = queue.Queue()
+
+        self._ids = itertools.count()
+        # number -> {id: handle}, oldest first.
+        self._by_number = collections.defaultdict(collections.OrderedDict)
+        # (number, timestamp) -> id
+        self._by_timestamp = {}
+        self._handles = {}
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._stopped = False
+
+
+    def __len__(self):
+        '''
+        Number of handles still awaiting receipts.
+        '''
+
+        with self._lock:
+            return len(self._handles)
+
+
+    #
+    ## Tracking.
+    #
+
+
+    def track(self, timestamp, recipients, timeout=None):
+        '''
+        Start tracking receipts for a message sent at the given timestamp
+        (milliseconds since the epoch), and return its handle.
+        '''
+
+        if timeout is None:
+            timeout = self.receipt_timeout
+
+        handle_id = next(self._ids)
+        handle = ReceiptHandle(handle_id, timestamp, recipients, time.monotonic() + timeout)
+
+        with self._lock:
+            self._handles[handle_id] = handle
+            for number in handle.recipients:
+                self._by_number[number][handle_id] = handle
+                self._by_timestamp[(number, timestamp)] = handle_id
+            self._start()
+            if len(self._handles) == 1:
+                self._wakeup.notify()
+
+        return handle
+
+
+    def update(self, handle, timestamp):
+        '''
+        Replace the approximate timestamp of a handle with the exact one
+        reported by signal-cli.
+        '''
+
+        with self._lock:
+            for number in handle.recipients:
+                if self._by_timestamp.get((number, handle.timestamp)) == handle.id:
+                    del self._by_timestamp[(number, handle.timestamp)]
+                self._by_timestamp[(number, timestamp)] = handle.id
+            handle.timestamp = timestamp
+
+
+    def cancel(self, handle):
+        '''
+        Stop tracking a handle, e.g. because sending the message failed.
+        '''
+
+        with self._lock:
+            self._remove(handle.id)
+        handle.future.cancel()
+
+
+    def _remove(self, handle_id):
+        '''
+        '''
+
+        handle = self._handles.pop(handle_id, None)
+        if handle is None:
+            return
+        for number in handle.recipients:
+            self._by_number[number].pop(handle_id, None)
+            if not self._by_number[number]:
+                del self._by_number[number]
+            if self._by_timestamp.get((number, handle.timestamp)) == handle_id:
+                del self._by_timestamp[(number, handle.timestamp)]
+
+
+    def _match(self, number, timestamp):
+        '''
+        Find the outstanding handle a receipt from number at timestamp belongs to.
+        '''
+
+        handle_id = self._by_timestamp.get((number, timestamp))
+        if handle_id is not None:
+            return handle_id
+
+        handles = self._by_number.get(number)
+        if handles:
+            handle_id, handle = next(iter(handles.items()))
+            if handle.timestamp <= timestamp:
+                return handle_id
+
+        return None
+
+
+    #
+    ## Dispatching.
+    #
+
+
+    def dispatch(self, messages):
+        '''
+        Resolve handles from any receipts in messages, and queue the rest.
+        '''
+
+        resolved = []
+
+        with self._lock:
+            for message in messages:
+                if not self._consume(message, resolved):
+                    self.inbound.put(message)
+
+        self._resolve(resolved)
+
+
+    def consume(self, message):
+        '''
+        Resolve handles from a single message, and return True if it was a
+        receipt for a tracked message, i.e. it should not be passed on.
+
+        Unlike dispatch(), other messages are not queued, so this can be used to
+        filter messages being handed straight to the caller.
+        '''
+
+        if not message["receipt"]:
+            return False
+
+        resolved = []
+        with self._lock:
+            consumed = self._consume(message, resolved)
+        self._resolve(resolved)
+        return consumed
+
+
+    def _consume(self, message, resolved):
+        '''
+        If message is a receipt for an outstanding handle, mark it received,
+        adding the handle to resolved if that was the last receipt it needed,
+        and return True. Called with the lock held.
+        '''
+
+        if not message["receipt"]:
+            return False
+
+        handle_id = self._match(message["number"], message["timestamp"])
+        if handle_id is None:
+            return False
+
+        handle = self._handles[handle_id]
+        handle.outstanding.discard(message["number"])
+        self._by_number[message["number"]].pop(handle_id, None)
+        if not handle.outstanding:
+            self._remove(handle_id)
+            resolved.append(handle)
+        return True
+
+
+    def _resolve(self, resolved):
+        '''
+        '''
+
+        observer = self.signal.observer
+        for handle in resolved:
+            if observer is not None:
+                observer.timing("receipt_wait_seconds", time.monotonic() - handle.created, {})
+            handle.future.set_result(handle.timestamp)
+
+
+    def expire(self):
+        '''
+        Fail all handles whose deadline has passed.
+        '''
+
+        now = time.monotonic()
+        expired = []
+
+        with self._lock:
+            for handle_id, handle in list(self._handles.items()):
+                if handle.deadline <= now:
+                    self._remove(handle_id)
+                    expired.append(handle)
+
+        for handle in expired:
+            handle.future.set_exception(
+                ReceiptNotFoundError(
+                    "no receipt for message {} from {}".format(
+                        handle.timestamp,
+                        ", ".join(sorted(handle.outstanding)),
+                    ),
+                ),
+            )
+
+
+    def poll(self):
+        '''
+        Receive messages from Signal once, and dispatch them.
+        '''
+
+        observer = self.signal.observer
+        if observer is not None:
+            start = time.perf_counter()
+
+        with self.signal.lock:
+            if observer is not None:
+                observer.timing(
+                    "lock_wait_seconds",
+                    time.perf_counter() - start,
+                    {"operation": "receive"},
+                )
+            messages = self.signal.receive_messages_get()
+        self.dispatch(messages)
+
+
+    def drain(self):
+        '''
+        Return all queued inbound messages.
+        '''
+
+        messages = []
+        while True:
+            try:
+                messages.append(self.inbound.get_nowait())
+            except queue.Empty:
+                return messages
+
+
+    #
+    ## Background receiver.
+    #
+
+
+    def _start(self):
+        '''
+        '''
+
+        if self._thread is None and not self._stopped:
+            self._thread = threading.Thread(
+                target=self._run,
+                name="pysignal-receipts-{}".format(self.signal.username),
+                daemon=True,
+            )
+            self._thread.start()
+
+
+    def stop(self):
+        '''
+        Stop the background receiver thread.
+        '''
+
+        with self._lock:
+            self._stopped = True
+            thread = self._thread
+            self._wakeup.notify()
+
+        if thread is not None:
+            thread.join()
+
+
+    def _run(self):
+        '''
+        '''
+
+        while True:
+            with self._lock:
+                # Only poll signal-cli while there is something to wait for.
+                while not self._handles and not self._stopped:
+                    self._wakeup.wait()
+                if self._stopped:
+                    return
+
+            try:
+                self.poll()
+            except Exception: # pylint: disable=broad-except
+                # Keep the receiver alive; handles will expire if this persists.
+                pass
+
+            self.expire()
+
+            with self._lock:
+                if self._stopped:
+                    return
+                self._wakeup.wait(self.poll_interval)
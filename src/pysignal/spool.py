@@ -0,0 +1,446 @@
+#
+# Signal Protocol Python library
+# pysignal/spool.py - durable outbound message spool
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Durable outbound message spool.
+'''
+
+
+import collections
+import concurrent.futures
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from pysignal.exception import DaemonError
+from pysignal.exception import SignalCLIError
+from pysignal.exception import SignalCLITimeoutError
+
+
+# One spool file per account, so accounts can share a spool directory.
+SPOOL_FILENAME = "outbound-{}.sqlite3"
+
+# signal-cli exit codes which mean retrying the whole call won't help:
+# 1 is a user error (e.g. invalid arguments), 4 an untrusted identity.
+# Anything else (2 unexpected error, 3 network error, ...) is retried.
+RETURNCODES_PERMANENT = frozenset((1, 4))
+
+# Seconds the background sender waits after an unexpected error.
+ERROR_WAIT = 1.0
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+
+SpoolEntry = collections.namedtuple(
+    "SpoolEntry",
+    ("id", "message", "recipient", "attachments", "state", "attempts", "error", "timestamp"),
+)
+
+
+class OutboundSpool(object):
+    '''
+    On-disk queue of outgoing messages, kept in an SQLite database.
+
+    Every recipient of a message is written to the spool before anything is
+    sent, and marked done once signal-cli has sent it. Recipients which fail
+    with a transient error are retried with exponential backoff and jitter,
+    up to max_attempts times; permanent failures are marked failed straight
+    away. Anything still pending when the spool is opened, e.g. after a
+    crash, is sent again, so delivery is at-least-once.
+
+    Writes from concurrent callers are committed together, so each fsync
+    covers as many messages as possible.
+    '''
+
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, signal, directory,
+                 max_attempts=8, backoff=1.0, max_backoff=300.0,
+                 batch_size=100, concurrency=4):
+        '''
+        '''
+
+        self.signal = signal
+        self.path = os.path.join(
+            directory,
+            SPOOL_FILENAME.format(signal.username.replace(os.sep, "_")),
+        )
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute(
+            '''CREATE TABLE IF NOT EXISTS outbound (
+                id INTEGER PRIMARY KEY,
+                message TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                attachments TEXT,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt REAL NOT NULL,
+                error TEXT,
+                timestamp INTEGER
+            )''',
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS outbound_due ON outbound (state, next_attempt)",
+        )
+        self._db.commit()
+
+        # Guards the connection. Commits are grouped: whoever commits writes
+        # out everything inserted so far, up to sequence number _written.
+        self._lock = threading.Lock()
+        self._written = 0
+        self._committed = 0
+        self._committing = False
+        self._commit_done = threading.Condition()
+
+        self._process_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+
+    #
+    ## Spooling.
+    #
+
+
+    def enqueue(self, message, recipients, attachments=None):
+        '''
+        Durably spool a message for the given recipients, and return the spool
+        IDs of its entries, one per recipient.
+        '''
+
+        return self.enqueue_many([(message, recipients, attachments)])
+
+
+    def enqueue_many(self, jobs):
+        '''
+        Durably spool many (message, recipients[, attachments]) jobs in a single
+        transaction, and return the spool IDs of their entries.
+        '''
+
+        now = time.time()
+        ids = []
+
+        with self._lock:
+            for job in jobs:
+                message, recipients = job[0], job[1]
+                attachments = job[2] if len(job) > 2 and job[2] else None
+                if attachments is not None:
+                    attachments = json.dumps(list(attachments))
+                for recipient in recipients:
+                    cursor = self._db.execute(
+                        "INSERT INTO outbound (message, recipient, attachments, state, next_attempt) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (message, recipient, attachments, PENDING, now),
+                    )
+                    ids.append(cursor.lastrowid)
+            self._written += 1
+            sequence = self._written
+
+        self._commit(sequence)
+        self._wakeup.set()
+        return ids
+
+
+    def _commit(self, sequence):
+        '''
+        Wait until everything up to the given write sequence number has been
+        committed, committing it ourselves if nobody else is.
+        '''
+
+        with self._commit_done:
+            while self._committed < sequence:
+                if not self._committing:
+                    self._committing = True
+                    break
+                self._commit_done.wait()
+            else:
+                return
+
+        try:
+            with self._lock:
+                written = self._written
+                self._db.commit()
+        finally:
+            with self._commit_done:
+                self._committing = False
+                self._committed = max(self._committed, written)
+                self._commit_done.notify_all()
+
+
+    #
+    ## Sending.
+    #
+
+
+    def delay(self, attempts):
+        '''
+        Return how long to wait before retrying an entry which has failed the
+        given number of times: exponential backoff, with the upper half jittered.
+        '''
+
+        delay = min(self.max_backoff, self.backoff * (2 ** (attempts - 1)))
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+    def process(self, limit=1000):
+        '''
+        Send up to limit entries which are due, and record the results.
+
+        Return the number of entries attempted.
+        '''
+
+        with self._process_lock:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT id, message, recipient, attachments, attempts FROM outbound "
+                    "WHERE state = ? AND next_attempt <= ? ORDER BY id LIMIT ?",
+                    (PENDING, time.time(), limit),
+                ).fetchall()
+
+            if not rows:
+                return 0
+
+            # Entries with the same content are sent to together, in batches.
+            groups = collections.OrderedDict()
+            for row in rows:
+                groups.setdefault((row[1], row[3]), []).append(row)
+            batches = [
+                (key, group[i:i + self.batch_size])
+                for key, group in groups.items()
+                for i in range(0, len(group), self.batch_size)
+            ]
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                outcomes = list(executor.map(lambda batch: self.send_batch(*batch), batches))
+
+            now = time.time()
+            updates = []
+            for (_, batch), (timestamp, errors) in zip(batches, outcomes):
+                for entry_id, _, recipient, _, attempts in batch:
+                    error, permanent = errors.get(recipient, (None, False))
+                    attempts += 1
+                    if error is None:
+                        updates.append((DONE, attempts, now, None, timestamp, entry_id))
+                    elif permanent or attempts >= self.max_attempts:
+                        updates.append((FAILED, attempts, now, error, None, entry_id))
+                    else:
+                        updates.append(
+                            (PENDING, attempts, now + self.delay(attempts), error, None, entry_id),
+                        )
+
+            with self._lock:
+                self._db.executemany(
+                    "UPDATE outbound SET state = ?, attempts = ?, next_attempt = ?, "
+                    "error = ?, timestamp = ? WHERE id = ?",
+                    updates,
+                )
+                self._written += 1
+                sequence = self._written
+            self._commit(sequence)
+
+            return len(rows)
+
+
+    def send_batch(self, key, batch):
+        '''
+        Send one batch of spooled entries, and return (timestamp, errors), where
+        errors maps each failed recipient to (error, permanent).
+        '''
+
+        message, attachments = key
+        if attachments is not None:
+            attachments = json.loads(attachments)
+        recipients = list(collections.OrderedDict((row[2], None) for row in batch))
+
+        try:
+            timestamp = self.signal.send_call(message, recipients, attachments=attachments)
+        except SignalCLIError as err:
+            errors = self.signal.send_errors_read(err.error_message or "")
+            if errors:
+                return (None, {
+                    recipient: (error, self.signal.send_error_permanent(error))
+                    for recipient, error in errors.items()
+                })
+            # Nothing to say which recipients failed, so go by the return code.
+            permanent = err.returncode in RETURNCODES_PERMANENT
+            return (None, {recipient: (str(err), permanent) for recipient in recipients})
+        except (SignalCLITimeoutError, DaemonError) as err:
+            return (None, {recipient: (str(err), False) for recipient in recipients})
+        except Exception as err: # pylint: disable=broad-except
+            # e.g. signal-cli missing: retry with backoff like any other failure.
+            return (None, {recipient: (repr(err), False) for recipient in recipients})
+
+        return (timestamp, {})
+
+
+    def next_due(self):
+        '''
+        Return the time the next pending entry is due to be sent, or None.
+        '''
+
+        with self._lock:
+            return self._db.execute(
+                "SELECT MIN(next_attempt) FROM outbound WHERE state = ?",
+                (PENDING,),
+            ).fetchone()[0]
+
+
+    #
+    ## Background sender.
+    #
+
+
+    def start(self):
+        '''
+        Start sending spooled entries in a background thread, beginning with
+        any left over from a previous run.
+        '''
+
+        if self._thread is None and not self._stopped:
+            self._thread = threading.Thread(
+                target=self._run,
+                name="pysignal-spool-{}".format(self.signal.username),
+                daemon=True,
+            )
+            self._thread.start()
+
+
+    def _run(self):
+        '''
+        '''
+
+        while not self._stopped:
+            self._wakeup.clear()
+            try:
+                if self.process():
+                    continue
+            except Exception: # pylint: disable=broad-except
+                # Keep the sender alive; entries stay pending until sent. Wait
+                # a while first, as whatever went wrong won't go away at once.
+                self._wakeup.wait(ERROR_WAIT)
+                continue
+
+            due = self.next_due()
+            timeout = None if due is None else max(0.0, due - time.time())
+            self._wakeup.wait(timeout)
+
+
+    def close(self):
+        '''
+        Stop the background sender and close the spool. Pending entries stay
+        on disk, to be sent when the spool is next opened.
+        '''
+
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            self._db.close()
+
+
+    #
+    ## Status.
+    #
+
+
+    def get(self, entry_id):
+        '''
+        Return the SpoolEntry with the given ID, or None.
+        '''
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, message, recipient, attachments, state, attempts, error, timestamp "
+                "FROM outbound WHERE id = ?",
+                (entry_id,),
+            ).fetchone()
+
+        return None if row is None else SpoolEntry(*_entry(row))
+
+
+    def entries(self, state=None):
+        '''
+        Return all SpoolEntries, or those in the given state.
+        '''
+
+        query = "SELECT id, message, recipient, attachments, state, attempts, error, timestamp " \
+                "FROM outbound"
+        params = ()
+        if state is not None:
+            query += " WHERE state = ?"
+            params = (state,)
+
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY id", params).fetchall()
+
+        return [SpoolEntry(*_entry(row)) for row in rows]
+
+
+    def stats(self):
+        '''
+        Return the number of entries in each state.
+        '''
+
+        with self._lock:
+            counts = dict(self._db.execute("SELECT state, COUNT(*) FROM outbound GROUP BY state"))
+
+        return {state: counts.get(state, 0) for state in (PENDING, DONE, FAILED)}
+
+
+    def purge(self, states=(DONE,)):
+        '''
+        Delete entries in the given states, and return how many were deleted.
+        '''
+
+        with self._lock:
+            cursor = self._db.execute(
+                "DELETE FROM outbound WHERE state IN ({})".format(", ".join("?" * len(states))),
+                tuple(states),
+            )
+            self._written += 1
+            sequence = self._written
+        self._commit(sequence)
+
+        return cursor.rowcount
+
+
+def _entry(row):
+    '''
+    '''
+
+    row = list(row)
+    if row[3] is not None:
+        row[3] = json.loads(row[3])
+    return row
@@ -0,0 +1,279 @@
+#
+# Signal Protocol Python library
+# pysignal/store.py - local inbound message store
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Local store of received messages and receipts.
+'''
+
+
+import os
+import sqlite3
+import threading
+import time
+
+from pysignal.parse import Envelope
+
+
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS envelopes (
+        id INTEGER PRIMARY KEY,
+        number TEXT NOT NULL,
+        device INTEGER,
+        timestamp INTEGER,
+        message_timestamp INTEGER,
+        receipt INTEGER NOT NULL,
+        body TEXT,
+        acknowledged INTEGER NOT NULL DEFAULT 0
+    )''',
+    # Deduplication. device and timestamp can be missing, and NULLs never
+    # compare equal, so index them with a placeholder instead.
+    '''CREATE UNIQUE INDEX IF NOT EXISTS envelopes_key
+        ON envelopes (number, IFNULL(device, -1), IFNULL(timestamp, -1))''',
+    "CREATE INDEX IF NOT EXISTS envelopes_number ON envelopes (number, timestamp)",
+    "CREATE INDEX IF NOT EXISTS envelopes_timestamp ON envelopes (timestamp)",
+    '''CREATE INDEX IF NOT EXISTS envelopes_receipts
+        ON envelopes (timestamp) WHERE receipt = 1''',
+    '''CREATE INDEX IF NOT EXISTS envelopes_unacknowledged
+        ON envelopes (id) WHERE acknowledged = 0 AND receipt = 0''',
+)
+
+COLUMNS = "number, device, timestamp, message_timestamp, receipt, body"
+
+
+class MessageStore(object):
+    '''
+    SQLite-backed store of received envelopes (messages and receipts).
+
+    Envelopes are deduplicated on (number, device, timestamp), so storing the
+    same envelope twice is harmless. Queries by sender, by time, for the
+    receipts of a sent message and for unacknowledged messages are answered
+    from indexes.
+    '''
+
+
+    def __init__(self, path):
+        '''
+        path is the SQLite database file, created if it does not exist.
+        '''
+
+        self.path = path
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            self._db.execute(statement)
+        self._db.commit()
+
+
+    def close(self):
+        '''
+        '''
+
+        with self._lock:
+            self._db.close()
+
+
+    #
+    ## Writing.
+    #
+
+
+    def add_many(self, envelopes):
+        '''
+        Store envelopes in a single transaction, skipping any already stored.
+        Return the number of new envelopes.
+        '''
+
+        rows = [
+            (
+                envelope["number"],
+                envelope["device"],
+                envelope["timestamp"],
+                envelope["message_timestamp"],
+                1 if envelope["receipt"] else 0,
+                envelope["body"],
+            )
+            for envelope in envelopes
+        ]
+        if not rows:
+            return 0
+
+        with self._lock:
+            before = self._db.total_changes
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO envelopes ({}) VALUES (?, ?, ?, ?, ?, ?)".format(COLUMNS),
+                    rows,
+                )
+            return self._db.total_changes - before
+
+
+    def recording(self, envelopes, batch_size=1000):
+        '''
+        Yield envelopes from an iterable, storing them in batches of up to
+        batch_size as they pass through.
+        '''
+
+        batch = []
+        try:
+            for envelope in envelopes:
+                batch.append(envelope)
+                if len(batch) >= batch_size:
+                    self.add_many(batch)
+                    batch = []
+                yield envelope
+        finally:
+            self.add_many(batch)
+
+
+    def acknowledge(self, envelopes):
+        '''
+        Mark envelopes as handled, so they are no longer returned by unacknowledged().
+        '''
+
+        rows = [
+            (
+                envelope["number"],
+                -1 if envelope["device"] is None else envelope["device"],
+                -1 if envelope["timestamp"] is None else envelope["timestamp"],
+            )
+            for envelope in envelopes
+        ]
+
+        with self._lock:
+            with self._db:
+                self._db.executemany(
+                    "UPDATE envelopes SET acknowledged = 1 "
+                    "WHERE number = ? AND IFNULL(device, -1) = ? AND IFNULL(timestamp, -1) = ?",
+                    rows,
+                )
+
+
+    #
+    ## Queries.
+    #
+
+
+    def _query(self, where, params, limit=None, order="timestamp"):
+        '''
+        '''
+
+        query = "SELECT {} FROM envelopes WHERE {} ORDER BY {}".format(COLUMNS, where, order)
+        if limit is not None:
+            query += " LIMIT ?"
+            params = tuple(params) + (limit,)
+
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+
+        return [
+            Envelope(number, device, timestamp, message_timestamp, bool(receipt), body)
+            for number, device, timestamp, message_timestamp, receipt, body in rows
+        ]
+
+
+    # pylint: disable=too-many-arguments
+    def messages(self, number=None, since=None, until=None, receipts=False, limit=None):
+        '''
+        Return stored envelopes, oldest first, optionally only those from the
+        given number and/or with timestamps in [since, until) (milliseconds
+        since the epoch). Receipts are left out unless receipts is True.
+        '''
+
+        where = []
+        params = []
+        if number is not None:
+            where.append("number = ?")
+            params.append(number)
+        if since is not None:
+            where.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("timestamp < ?")
+            params.append(until)
+        if not receipts:
+            where.append("receipt = 0")
+
+        return self._query(" AND ".join(where) or "1", params, limit)
+
+
+    def receipts(self, timestamp):
+        '''
+        Return the receipts for the message sent at the given timestamp.
+        '''
+
+        return self._query("receipt = 1 AND timestamp = ?", (timestamp,))
+
+
+    def unacknowledged(self, limit=None):
+        '''
+        Return messages (not receipts) which have not been acknowledged, in
+        the order they were stored.
+        '''
+
+        return self._query("acknowledged = 0 AND receipt = 0", (), limit, order="id")
+
+
+    def __len__(self):
+        '''
+        '''
+
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM envelopes").fetchone()[0]
+
+
+    #
+    ## Retention.
+    #
+
+
+    def prune(self, max_age, unacknowledged=False):
+        '''
+        Delete envelopes older than max_age seconds, and return how many were
+        deleted. Unacknowledged messages are kept unless unacknowledged is True.
+        '''
+
+        cutoff = int((time.time() - max_age) * 1000)
+        where = "timestamp < ?"
+        if not unacknowledged:
+            where += " AND (acknowledged = 1 OR receipt = 1)"
+
+        with self._lock:
+            with self._db:
+                return self._db.execute(
+                    "DELETE FROM envelopes WHERE {}".format(where),
+                    (cutoff,),
+                ).rowcount
+
+
+    def compact(self):
+        '''
+        Reclaim space left by deleted envelopes.
+        '''
+
+        with self._lock:
+            self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._db.execute("VACUUM")
@@ -0,0 +1,262 @@
+#
+# Signal Protocol Python library
+# pysignal/subscription.py - continuous receive subscriptions
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Continuous receive subscriptions.
+'''
+
+
+import queue
+import threading
+import time
+import zlib
+
+
+class Subscription(object):
+    '''
+    Receives messages continuously, passing each one to handler(envelope) on a
+    pool of worker threads.
+
+    A single receive loop long-polls signal-cli, so a receive is always
+    waiting for new messages. Each receive waits up to poll_timeout seconds;
+    after one returns nothing, the next waits twice as long, up to
+    max_poll_timeout, so an idle account costs fewer signal-cli runs. As soon
+    as messages arrive, it goes back to poll_timeout.
+
+    If receiving fails, the loop waits before trying again, doubling the wait
+    each time from min_interval up to max_interval.
+
+    Messages from the same sender always go to the same worker, so handlers
+    for one sender run in the order the messages were received. Each worker
+    queues at most queue_size messages; when a queue is full the receive loop
+    waits for it, rather than buffering without limit.
+
+    Receipts are matched against the Signal instance's receipt tracker as
+    usual, and not passed to handlers.
+    '''
+
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, signal, handler, workers=4,
+                 poll_timeout=5, max_poll_timeout=30,
+                 min_interval=0.1, max_interval=30.0, queue_size=1000):
+        '''
+        '''
+
+        self.signal = signal
+        self.handler = handler
+        self.poll_timeout = poll_timeout
+        self.max_poll_timeout = max_poll_timeout
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+        self.timeout = poll_timeout
+        self.interval = 0.0
+
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._counts = {
+            "received": 0,
+            "handled": 0,
+            "handler_errors": 0,
+            "receive_errors": 0,
+        }
+        self._lag_last = None
+        self._lag_max = 0.0
+        self._lag_total = 0.0
+        self._lag_count = 0
+        self.last_error = None
+
+        self._queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self._workers = [
+            threading.Thread(
+                target=self._work,
+                args=(work_queue,),
+                name="pysignal-subscription-{}-{}".format(signal.username, index),
+                daemon=True,
+            )
+            for index, work_queue in enumerate(self._queues)
+        ]
+        self._receiver = threading.Thread(
+            target=self._receive,
+            name="pysignal-subscription-{}".format(signal.username),
+            daemon=True,
+        )
+
+
+    def start(self):
+        '''
+        '''
+
+        for worker in self._workers:
+            worker.start()
+        self._receiver.start()
+        return self
+
+
+    def stop(self, timeout=None):
+        '''
+        Stop receiving, and wait for handlers to finish the messages already
+        received. A receive in progress is allowed to finish first, which can
+        take up to max_poll_timeout seconds.
+        '''
+
+        self._stopped.set()
+        self._receiver.join(timeout)
+        for work_queue in self._queues:
+            work_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+
+
+    def __enter__(self):
+        '''
+        '''
+
+        return self
+
+
+    def __exit__(self, *exc_info):
+        '''
+        '''
+
+        self.stop()
+
+
+    #
+    ## Receiving.
+    #
+
+
+    def _receive(self):
+        '''
+        Receive loop.
+        '''
+
+        signal = self.signal
+
+        while not self._stopped.is_set():
+            try:
+                with signal.lock:
+                    messages = signal.receive_messages_get(self.timeout)
+                signal.receipts.dispatch(messages)
+            except Exception as err: # pylint: disable=broad-except
+                with self._lock:
+                    self._counts["receive_errors"] += 1
+                    self.last_error = err
+                self.interval = min(self.max_interval, max(self.min_interval, self.interval * 2))
+                self._stopped.wait(self.interval)
+                continue
+
+            self.interval = 0.0
+
+            # Everything that isn't a receipt for a tracked message, including
+            # messages received meanwhile by the receipt tracker.
+            messages = signal.receipts.drain()
+            for message in messages:
+                if message["receipt"]:
+                    continue
+                self._queues[self.worker_for(message["number"])].put(
+                    (message, time.monotonic()),
+                )
+                with self._lock:
+                    self._counts["received"] += 1
+
+            # No wait between receives, so one is always listening.
+            if messages:
+                self.timeout = self.poll_timeout
+            else:
+                self.timeout = min(self.max_poll_timeout, self.timeout * 2)
+
+
+    def worker_for(self, number):
+        '''
+        Return the index of the worker handling messages from the given number.
+        '''
+
+        return zlib.crc32(number.encode("utf-8")) % len(self._queues)
+
+
+    #
+    ## Handling.
+    #
+
+
+    def _work(self, work_queue):
+        '''
+        Handler worker loop.
+        '''
+
+        observer = self.signal.observer
+
+        for message, queued in iter(work_queue.get, None):
+            started = time.monotonic()
+
+            # Lag: from the message being sent to its handler starting.
+            lag = None
+            if message["timestamp"] is not None:
+                lag = max(0.0, time.time() - message["timestamp"] / 1000.0)
+
+            if observer is not None:
+                observer.timing("handler_queue_seconds", started - queued, {})
+                if lag is not None:
+                    observer.timing("subscription_lag_seconds", lag, {})
+
+            try:
+                self.handler(message)
+                error = None
+            except Exception as err: # pylint: disable=broad-except
+                error = err
+
+            with self._lock:
+                self._counts["handled"] += 1
+                if error is not None:
+                    self._counts["handler_errors"] += 1
+                    self.last_error = error
+                if lag is not None:
+                    self._lag_last = lag
+                    self._lag_max = max(self._lag_max, lag)
+                    self._lag_total += lag
+                    self._lag_count += 1
+
+
+    #
+    ## Status.
+    #
+
+
+    def stats(self):
+        '''
+        Return message counts, queue depth, current receive timeout, current
+        wait after receive errors, and lag (in seconds, from a message being
+        sent to its handler starting).
+        '''
+
+        with self._lock:
+            stats = dict(self._counts)
+            stats["lag_last"] = self._lag_last
+            stats["lag_max"] = self._lag_max
+            stats["lag_mean"] = self._lag_total / self._lag_count if self._lag_count else None
+
+        stats["queued"] = sum(work_queue.qsize() for work_queue in self._queues)
+        stats["timeout"] = self.timeout
+        stats["interval"] = self.interval
+        stats["running"] = self._receiver.is_alive()
+        return stats
@@ -0,0 +1,59 @@
+#
+# Signal Protocol Python library
+# tests/tests/__init__.py - unit tests
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Unit tests, run with "make test".
+'''
+
+
+import os
+import sys
+import unittest
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(os.path.dirname(TESTS_DIR))
+
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+
+# The fake signal-cli used for benchmarking, which tests also run against.
+SIGNAL_CLI = os.path.join(ROOT_DIR, "benchmarks", "signal-cli")
+
+# Test against the source tree, not an installed copy.
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+
+def main():
+    '''
+    '''
+
+    sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+    suite = unittest.defaultTestLoader.discover(
+        TESTS_DIR,
+        top_level_dir=os.path.dirname(TESTS_DIR),
+    )
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    return 0 if result.wasSuccessful() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+#
+# Signal Protocol Python library
+# tests/tests/test_aio.py - asyncio client tests
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+asyncio client tests.
+'''
+
+
+import asyncio
+import unittest
+
+from pysignal.aio import AsyncSignal
+
+from tests import SIGNAL_CLI
+
+
+class TestAsyncSignal(unittest.TestCase):
+    '''
+    '''
+
+
+    def test_loops(self):
+        '''
+        A client made before its loop, and used from more than one loop, can
+        still limit concurrency.
+        '''
+
+        signal = AsyncSignal("+6421000000", signal_cli=SIGNAL_CLI, max_concurrency=2)
+
+        for _ in range(2):
+            loop = asyncio.new_event_loop()
+            try:
+                asyncio.set_event_loop(loop)
+                results = loop.run_until_complete(asyncio.gather(*[
+                    signal.send("hello", recipient="+6421000001")
+                    for _ in range(6)
+                ]))
+            finally:
+                asyncio.set_event_loop(None)
+                loop.close()
+
+            self.assertEqual(results, [None] * 6)
+
+
+if __name__ == "__main__":
+    unittest.main()
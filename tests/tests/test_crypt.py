@@ -0,0 +1,120 @@
+#
+# Signal Protocol Python library
+# tests/tests/test_crypt.py - message encryption tests
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Message encryption tests. Skipped if the cryptography package is not installed.
+'''
+
+
+import unittest
+
+from pysignal import crypt
+from pysignal.exception import SessionNotFoundError
+
+
+SECRET = b"shared session secret"
+
+
+@unittest.skipIf(crypt.AESGCM is None, "the cryptography package is not installed")
+class TestSessionCache(unittest.TestCase):
+    '''
+    '''
+
+
+    def setUp(self):
+        '''
+        '''
+
+        self.sender = crypt.SessionCache()
+        self.receiver = crypt.SessionCache(workers=2)
+        for cache in (self.sender, self.receiver):
+            cache.add("+6421000001", SECRET)
+            cache.add("+6421000002", SECRET + b"2")
+
+
+    def tearDown(self):
+        '''
+        '''
+
+        self.sender.close()
+        self.receiver.close()
+
+
+    def test_round_trip(self):
+        '''
+        '''
+
+        data = self.sender.encrypt("+6421000001", b"hello", b"header")
+
+        self.assertEqual(len(data), len(b"hello") + crypt.OVERHEAD)
+        self.assertEqual(self.receiver.decrypt("+6421000001", data, b"header"), b"hello")
+        with self.assertRaises(Exception):
+            self.receiver.decrypt("+6421000002", data, b"header")
+
+
+    def test_round_trip_many(self):
+        '''
+        Big enough batches to be split across the receiver's thread pool.
+        '''
+
+        items = [
+            ("+642100000{}".format(1 + i % 2), "message {}".format(i).encode())
+            for i in range(crypt.PARALLEL_THRESHOLD * 2)
+        ]
+
+        buffer, offsets = self.sender.encrypt_many(items)
+        encrypted = [
+            (recipient, bytes(buffer[start:end]))
+            for (recipient, _), (start, end) in zip(items, offsets)
+        ]
+        buffer, offsets = self.receiver.decrypt_many(encrypted)
+
+        self.assertEqual(
+            [bytes(buffer[start:end]) for start, end in offsets],
+            [plaintext for _, plaintext in items],
+        )
+
+
+    def test_nonces_unique_across_sessions(self):
+        '''
+        Sessions started again with the same secret don't reuse nonces.
+        '''
+
+        nonces = set()
+        for _ in range(100):
+            self.sender.evict("+6421000001")
+            self.sender.add("+6421000001", SECRET)
+            for _ in range(10):
+                nonces.add(self.sender.encrypt("+6421000001", b"")[:crypt.NONCE_SIZE])
+
+        self.assertEqual(len(nonces), 1000)
+
+
+    def test_evicted(self):
+        '''
+        '''
+
+        self.sender.evict("+6421000001")
+        with self.assertRaises(SessionNotFoundError):
+            self.sender.encrypt("+6421000001", b"hello")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,180 @@
+#
+# Signal Protocol Python library
+# tests/tests/test_parse.py - signal-cli output parser tests
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+signal-cli output parser tests.
+'''
+
+
+import io
+import os
+import subprocess
+import unittest
+
+from pysignal import Signal
+from pysignal import parse
+from pysignal.exception import ParseError
+
+from tests import SIGNAL_CLI
+
+
+def signal_cli_output(*args, **env):
+    '''
+    Run the fake signal-cli, and return its output.
+    '''
+
+    environ = dict(os.environ)
+    environ.update(
+        ("FAKE_SIGNAL_CLI_{}".format(key), str(value))
+        for key, value in env.items()
+    )
+
+    return subprocess.check_output(
+        [SIGNAL_CLI, "-u", "+6421000000"] + list(args),
+        env=environ,
+        universal_newlines=True,
+    )
+
+
+class TestOutputConformance(unittest.TestCase):
+    '''
+    The text and JSON output parsers give identical records for the same input.
+    '''
+
+
+    def test_messages(self):
+        '''
+        '''
+
+        text = signal_cli_output("receive", MESSAGES=200, SEED=1)
+        json_text = signal_cli_output("--output=json", "receive", MESSAGES=200, SEED=1)
+
+        messages = parse.messages_read(text)
+
+        self.assertEqual(len(messages), 200)
+        self.assertTrue(any(message.receipt for message in messages))
+        self.assertEqual(messages, parse.messages_json_read(json_text))
+        self.assertEqual(messages, list(parse.messages_iter(io.StringIO(text))))
+        self.assertEqual(messages, list(parse.messages_json_iter(io.StringIO(json_text))))
+
+
+    def test_identities(self):
+        '''
+        '''
+
+        text = signal_cli_output("listIdentities", IDENTITIES=20)
+        json_text = signal_cli_output("--output=json", "listIdentities", IDENTITIES=20)
+
+        identities = parse.identities_read(text)
+
+        self.assertEqual(len(identities), 20)
+        self.assertIsInstance(identities[0].added_date, str)
+        self.assertEqual(identities, parse.identities_json_read(json_text))
+
+
+    def test_identities_daemon(self):
+        '''
+        The JSON-RPC daemon gives the same identities as text output.
+        '''
+
+        text = signal_cli_output("listIdentities", IDENTITIES=10)
+
+        signal = Signal("+6421000000", signal_cli=SIGNAL_CLI, daemon=True)
+        try:
+            self.assertEqual(signal.list_identities(), parse.identities_read(text))
+        finally:
+            signal.close()
+
+
+class TestIdentities(unittest.TestCase):
+    '''
+    '''
+
+    # As printed by signal-cli: the fingerprint is the serialized identity key,
+    # a 05 type byte followed by the 32 byte key.
+    LINE = (
+        "+6421000001: TRUSTED_UNVERIFIED Added: Mon Nov 27 01:26:58 NZDT 2017 "
+        "Fingerprint: 05 1b 2c 3d 4e 5f 60 71 82 93 a4 b5 c6 d7 e8 f9 0a 1b 2c 3d 4e 5f 60 71 "
+        "82 93 a4 b5 c6 d7 e8 f9 0a  "
+        "Safety Number: 12345 23456 34567 45678 56789 67890 78901 89012 90123 01234 12345 23456"
+    )
+
+
+    def test_signal_cli_line(self):
+        '''
+        '''
+
+        identities = parse.identities_read(self.LINE + "\n")
+
+        self.assertEqual(len(identities), 1)
+        self.assertEqual(identities[0].number, "+6421000001")
+        self.assertEqual(identities[0].status, "TRUSTED_UNVERIFIED")
+        self.assertEqual(identities[0].added_date, "Mon Nov 27 01:26:58 NZDT 2017")
+        self.assertEqual(len(bytes.fromhex(identities[0].fingerprint)), 33)
+        self.assertEqual(identities[0].safety_number, self.LINE.rpartition(": ")[2])
+
+
+    def test_invalid_lines(self):
+        '''
+        '''
+
+        for line in (
+                self.LINE.replace("TRUSTED_UNVERIFIED", "TRUSTED"),
+                self.LINE.replace("05 1b", "05 1g"),
+                self.LINE.replace("05 1b", "051b"),
+                self.LINE.replace("12345 23456", "12345 2345"),
+                self.LINE.replace("+6421000001", "6421000001"),
+        ):
+            with self.subTest(line=line), self.assertRaises(ParseError):
+                parse.identities_read(line)
+
+
+class TestEnvelopeFromJSON(unittest.TestCase):
+    '''
+    '''
+
+
+    def test_receipt_timestamps(self):
+        '''
+        Receipts carry the timestamps of the messages they acknowledge.
+        '''
+
+        envelopes = parse.envelopes_from_json({
+            "source": "+6421000001",
+            "sourceDevice": 2,
+            "timestamp": 1511746019000,
+            "receiptMessage": {
+                "when": 1511746019000,
+                "isDelivery": True,
+                "timestamps": [1511746018074, 1511746018075],
+            },
+        })
+
+        self.assertEqual(
+            envelopes,
+            [
+                parse.Envelope("+6421000001", 2, 1511746018074, None, True),
+                parse.Envelope("+6421000001", 2, 1511746018075, None, True),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+#
+# Signal Protocol Python library
+# tests/tests/test_receipt.py - delivery receipt tracking tests
+#
+# Copyright (c) 2017 Catalyst.net Ltd
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+'''
+Delivery receipt tracking tests.
+'''
+
+
+import os
+import unittest
+import unittest.mock
+
+from pysignal import Signal
+
+from tests import SIGNAL_CLI
+
+
+# The fake signal-cli's first message is from this number, at this timestamp.
+NUMBER = "+64210000000"
+TIMESTAMP = 1511746018075
+
+
+class TestReceiveIter(unittest.TestCase):
+    '''
+    '''
+
+
+    def test_receipts_resolve_handles(self):
+        '''
+        Receipts for tracked messages resolve their handles, and are not yielded.
+        '''
+
+        environ = {"FAKE_SIGNAL_CLI_MESSAGES": "3", "FAKE_SIGNAL_CLI_RECEIPTS": "1"}
+
+        for output in ("text", "json"):
+            with self.subTest(output=output), unittest.mock.patch.dict(os.environ, environ):
+                signal = Signal("+6421999999", signal_cli=SIGNAL_CLI, output=output)
+                # Receive only through receive_iter(), not in the background.
+                signal.receipts.stop()
+
+                handle = signal.receipts.track(TIMESTAMP, [NUMBER])
+                messages = list(signal.receive_iter())
+
+                self.assertTrue(handle.done())
+                self.assertEqual(len(messages), 2)
+                self.assertNotIn(NUMBER, [message.number for message in messages])
+
+                signal.close()
+
+
+if __name__ == "__main__":
+    unittest.main()